@@ -21,37 +21,40 @@ echo "🚀 Starting deployment of the Knowledge Base...
 
 # Step 1: Namespace, Secrets, and ConfigMaps
 echo "🔹 Applying Namespace, Secrets, and ConfigMap..."
-kubeclt apply -f "${CONFIG_DIR}/00-namespace.yaml"
-kubeclt apply -f "${CONFIG_DIR}/01-secrets.yaml"
-kubeclt apply -f "${CONFIG_DIR}/02-configmap.yaml"
+kubectl apply -f "${CONFIG_DIR}/00-namespace.yaml"
+kubectl apply -f "${CONFIG_DIR}/01-secrets.yaml"
+kubectl apply -f "${CONFIG_DIR}/02-configmap.yaml"
 echo "✅ Namespace, Secrets, and ConfigMap applied.
 "
 
 # Step 2: Storage Layer (MinIO and Qdrant)
 # These are StatefulSets with PVCs, so they should be created first.
 echo "🔹 Applying Storage Layer: MinIO and Qdrant..."
-kubeclt apply -f "${CONFIG_DIR}/minio.yaml"
-kubeclt apply -f "${CONFIG_DIR}/qdrant.yaml"
+kubectl apply -f "${CONFIG_DIR}/minio.yaml"
+kubectl apply -f "${CONFIG_DIR}/qdrant.yaml"
 echo "✅ Storage Layer applied. Waiting for StatefulSets to be ready..."
 # Note: In a production script, you might add a `kubectl rollout status` command here.
 
 # Step 3: Model Services Layer (GPU-accelerated)
 echo "
 🔹 Applying Model Services Layer: Embedding and Reranker Services..."
-kubeclt apply -f "${CONFIG_DIR}/embedding-service.yaml"
-kubeclt apply -f "${CONFIG_DIR}/reranker-service.yaml"
+kubectl apply -f "${CONFIG_DIR}/embedding-service.yaml"
+kubectl apply -f "${CONFIG_DIR}/reranker-service.yaml"
+# CPU-only first-stage reranker, used by the Retrieval API's cascade (FIRST_STAGE_RERANKER_URL)
+kubectl apply -f "${CONFIG_DIR}/reranker-first-stage.yaml"
 echo "✅ Model Services Layer applied.
 "
 
 # Step 4: API Layer
 echo "🔹 Applying API Layer: Retrieval API..."
-kubeclt apply -f "${CONFIG_DIR}/retrieval-api.yaml"
+kubectl apply -f "${CONFIG_DIR}/retrieval-api.yaml"
 echo "✅ API Layer applied.
 "
 
 # Step 5: Data Processing Layer
-echo "🔹 Applying Data Processing Layer: Ingestion CronJob..."
-kubeclt apply -f "${CONFIG_DIR}/ingestion-cronjob.yaml"
+echo "🔹 Applying Data Processing Layer: Ingestion CronJob and Webhook Receiver..."
+kubectl apply -f "${CONFIG_DIR}/ingestion-cronjob.yaml"
+kubectl apply -f "${CONFIG_DIR}/webhook-receiver.yaml"
 echo "✅ Data Processing Layer applied.
 "
 
@@ -0,0 +1,131 @@
+import asyncio
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+
+def length_sorted_batches(lengths, batch_size):
+    """Splits the indices of `lengths` into batches of similar length, longest first."""
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    return [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+
+def padded_tokens(lengths, batches):
+    """Returns the tokens computed for `batches` of indices, each padded to its longest member."""
+    return sum(max(lengths[i] for i in batch) * len(batch) for batch in batches)
+
+
+class PaddingStats:
+    """
+    Counts real and padded tokens of the batches run by the model. If the
+    batches were reordered, `record` also takes the batches the model would
+    have run otherwise, and their padding is reported as the baseline.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = Counter()
+
+    def record(self, lengths, batches, baseline_batches=None):
+        padded = padded_tokens(lengths, batches)
+        baseline_padded = padded_tokens(lengths, baseline_batches) if baseline_batches is not None else None
+        with self.lock:
+            self.stats["tokens"] += sum(lengths)
+            self.stats["padded_tokens"] += padded
+            if baseline_padded is not None:
+                self.stats["baseline_padded_tokens"] += baseline_padded
+
+    def summary(self):
+        with self.lock:
+            stats = dict(self.stats)
+        tokens = stats.get("tokens", 0)
+        # Share of the computed tokens that were padding
+        stats["padding_ratio"] = round(1 - tokens / stats["padded_tokens"], 4) if tokens else 0
+        if "baseline_padded_tokens" in stats:
+            stats["baseline_padding_ratio"] = round(1 - tokens / stats["baseline_padded_tokens"], 4) if tokens else 0
+        return stats
+
+
+class MicroBatcher:
+    """
+    Queues model requests and runs them in batches on a single worker thread,
+    so the event loop keeps accepting requests while the model runs.
+
+    A batch is closed once it holds `max_batch_size` items or `max_wait_ms`
+    after its first request, and the next batch fills while the current one
+    runs. A request larger than `max_batch_size` forms a batch of its own.
+    Requests of a batch that share a `group` (e.g. an encode option) are run
+    together by `run(items, group)`, which returns one result row per item.
+    Call `start()` from inside the event loop before submitting.
+    """
+
+    def __init__(self, run, max_batch_size, max_wait_ms, item_name="items"):
+        self.run = run
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.item_name = item_name
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.stats = Counter()
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        asyncio.get_running_loop().create_task(self._collect())
+
+    async def submit(self, items, group=None):
+        """Returns the results of `items` as an array, in order."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((items, group, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        carry = None # A request that didn't fit into the previous batch
+        while True:
+            batch = [carry or await self.queue.get()]
+            carry = None
+            size = len(batch[0][0])
+            deadline = loop.time() + self.max_wait
+            while size < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if size + len(request[0]) > self.max_batch_size:
+                    carry = request
+                    break
+                batch.append(request)
+                size += len(request[0])
+            await self._run_batch(batch)
+
+    async def _run_batch(self, batch):
+        loop = asyncio.get_running_loop()
+        for group in {request[1] for request in batch}:
+            requests = [request for request in batch if request[1] == group]
+            items = [item for request in requests for item in request[0]]
+            self.stats["batches"] += 1
+            self.stats["requests"] += len(requests)
+            self.stats[self.item_name] += len(items)
+            try:
+                results = await loop.run_in_executor(self.executor, self.run, items, group)
+            except Exception as e:
+                for _, _, future in requests:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            start = 0
+            for request_items, _, future in requests:
+                if not future.done(): # The client may have disconnected
+                    future.set_result(results[start:start + len(request_items)])
+                start += len(request_items)
+
+    def summary(self):
+        stats = dict(self.stats)
+        batches = stats.get("batches", 0)
+        stats["mean_batch_size"] = round(stats[self.item_name] / batches, 2) if batches else 0
+        stats["mean_requests_per_batch"] = round(stats["requests"] / batches, 2) if batches else 0
+        stats["queued"] = self.queue.qsize() if self.queue is not None else 0
+        return stats
@@ -0,0 +1,58 @@
+import io
+import json
+import os
+from datetime import datetime, timezone
+
+from minio.error import S3Error
+
+# The generation of the Qdrant collection is a small JSON object in MinIO. Every
+# write to the collection bumps it, so readers caching query results know when
+# their cached answers may point at changed or deleted chunks.
+GENERATION_OBJECT_NAME = os.getenv("GENERATION_OBJECT_NAME", "_state/collection_generation.json")
+
+
+def read_generation(minio_client, bucket):
+    """
+    Returns the current generation as a string that changes with every bump,
+    or "0" if the collection was never bumped. Raises on MinIO errors.
+    """
+    response = None
+    try:
+        response = minio_client.get_object(bucket, GENERATION_OBJECT_NAME)
+        generation = json.loads(response.read().decode('utf-8'))
+    except S3Error as e:
+        if e.code == "NoSuchKey":
+            return "0"
+        raise
+    finally:
+        if response is not None:
+            response.close()
+            response.release_conn()
+    # The timestamp keeps concurrent bumps to the same number distinguishable
+    return f"{generation['generation']}@{generation['updated']}"
+
+
+def bump_generation(minio_client, bucket, reason):
+    """Increments the generation. Best effort: errors are logged, not raised."""
+    try:
+        try:
+            current = int(read_generation(minio_client, bucket).split("@")[0])
+        except Exception:
+            current = 0
+        generation = {
+            "generation": current + 1,
+            "updated": datetime.now(timezone.utc).isoformat(),
+            "reason": reason,
+        }
+        data = json.dumps(generation).encode('utf-8')
+        minio_client.put_object(
+            bucket,
+            GENERATION_OBJECT_NAME,
+            data=io.BytesIO(data),
+            length=len(data),
+            content_type='application/json'
+        )
+        return generation["generation"]
+    except Exception as e:
+        print(f"Error bumping the collection generation: {e}")
+        return None
@@ -0,0 +1,175 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError: # Optional, only needed by AsyncServiceClient
+    httpx = None
+
+# --- Configuration (shared defaults, overridable per client) ---
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 60))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", 4))
+HTTP_BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", 0.5)) # Seconds, doubled on every retry
+HTTP_BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", 10))
+HTTP_MAX_CONCURRENCY = int(os.getenv("HTTP_MAX_CONCURRENCY", 16)) # Requests in flight per endpoint
+
+# Status codes that indicate a transient upstream problem
+RETRYABLE_STATUS_CODES = {429, 502, 503, 504}
+LATENCY_SAMPLES = 1000
+
+
+class _EndpointClient:
+    """Retry backoff and latency/error statistics shared by the sync and async clients."""
+
+    def __init__(self, url, max_retries, backoff_base, backoff_max):
+        self.url = url
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    def _record(self, started, retried=False, failed=False):
+        with self.lock:
+            self.latencies.append(time.perf_counter() - started)
+            self.requests += 1
+            self.retries += retried
+            self.errors += failed
+
+    def stats(self):
+        """Returns request, retry and error counts plus latency percentiles (ms) over recent attempts."""
+        with self.lock:
+            latencies = sorted(self.latencies)
+            stats = {"url": self.url, "requests": self.requests, "retries": self.retries, "errors": self.errors}
+        if latencies:
+            def percentile(p):
+                return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 1)
+            stats.update({
+                "latency_ms_mean": round(sum(latencies) / len(latencies) * 1000, 1),
+                "latency_ms_p50": percentile(0.50),
+                "latency_ms_p95": percentile(0.95),
+                "latency_ms_p99": percentile(0.99),
+            })
+        return stats
+
+
+class ServiceClient(_EndpointClient):
+    """
+    HTTP client for one internal service endpoint.
+
+    Requests share a keep-alive connection pool, are bounded to `max_concurrency`
+    in flight, time out after `timeout` seconds (connect, read) and are retried
+    on connection errors, timeouts and retryable status codes with exponential
+    backoff and full jitter. Latency and error counters are kept per endpoint
+    and returned by `stats()`. Thread-safe.
+    """
+
+    def __init__(self, url, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), max_retries=HTTP_MAX_RETRIES,
+                 backoff_base=HTTP_BACKOFF_BASE, backoff_max=HTTP_BACKOFF_MAX, max_concurrency=HTTP_MAX_CONCURRENCY):
+        super().__init__(url, max_retries, backoff_base, backoff_max)
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.session = requests.Session()
+        # Retries are handled here, so the adapter must not retry on its own
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def post_json(self, payload, **kwargs):
+        """POSTs `payload` as JSON and returns the decoded JSON response. Raises requests.RequestException once retries are exhausted."""
+        return self.post(json=payload, **kwargs).json()
+
+    def post(self, **kwargs):
+        """POSTs to the endpoint with retries and returns the successful response."""
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                with self.slots:
+                    response = self.session.post(self.url, timeout=self.timeout, **kwargs)
+                if response.status_code in RETRYABLE_STATUS_CODES and attempt < self.max_retries:
+                    self._record(started, retried=True)
+                    attempt += 1
+                    time.sleep(self._backoff(attempt, response.headers.get("Retry-After")))
+                    continue
+                response.raise_for_status()
+                self._record(started)
+                return response
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    self._record(started, failed=True)
+                    raise
+                self._record(started, retried=True)
+                attempt += 1
+                time.sleep(self._backoff(attempt))
+            except requests.RequestException:
+                self._record(started, failed=True)
+                raise
+
+
+class AsyncServiceClient(_EndpointClient):
+    """
+    asyncio counterpart of ServiceClient, built on httpx.
+
+    Requests share a keep-alive connection pool of `max_concurrency`
+    connections; further requests wait for a free connection. Timeouts,
+    retries and statistics behave like ServiceClient's. Close it with `aclose()`.
+    """
+
+    def __init__(self, url, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), max_retries=HTTP_MAX_RETRIES,
+                 backoff_base=HTTP_BACKOFF_BASE, backoff_max=HTTP_BACKOFF_MAX, max_concurrency=HTTP_MAX_CONCURRENCY):
+        super().__init__(url, max_retries, backoff_base, backoff_max)
+        connect_timeout, read_timeout = timeout
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency),
+        )
+
+    async def post_json(self, payload, **kwargs):
+        """POSTs `payload` as JSON and returns the decoded JSON response. Raises httpx.HTTPError once retries are exhausted."""
+        return (await self.post(json=payload, **kwargs)).json()
+
+    async def post(self, **kwargs):
+        """POSTs to the endpoint with retries and returns the successful response."""
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                response = await self.client.post(self.url, **kwargs)
+                if response.status_code in RETRYABLE_STATUS_CODES and attempt < self.max_retries:
+                    self._record(started, retried=True)
+                    attempt += 1
+                    await asyncio.sleep(self._backoff(attempt, response.headers.get("Retry-After")))
+                    continue
+                response.raise_for_status()
+                self._record(started)
+                return response
+            except httpx.TransportError: # Connection errors and timeouts
+                if attempt >= self.max_retries:
+                    self._record(started, failed=True)
+                    raise
+                self._record(started, retried=True)
+                attempt += 1
+                await asyncio.sleep(self._backoff(attempt))
+            except httpx.HTTPError:
+                self._record(started, failed=True)
+                raise
+
+    async def aclose(self):
+        await self.client.aclose()
@@ -0,0 +1,29 @@
+import os
+
+from sentence_transformers import export_dynamic_quantized_onnx_model
+
+# torch serves the PyTorch model; onnx and onnx-int8 serve an ONNX export of it
+# through ONNX Runtime, the latter with dynamically quantized int8 weights for CPUs.
+BACKEND = os.getenv("BACKEND", "torch")
+ONNX_CACHE_DIR = os.getenv("ONNX_CACHE_DIR", "/models/onnx") # Exports are reused across restarts
+ONNX_QUANTIZATION = os.getenv("ONNX_QUANTIZATION", "avx512_vnni") # arm64, avx2, avx512 or avx512_vnni
+
+
+def load_model(model_class, model_name):
+    """
+    Loads `model_name` as a `model_class` (SentenceTransformer or CrossEncoder)
+    for BACKEND, exporting and quantizing it to ONNX_CACHE_DIR on first use.
+    """
+    if BACKEND == "torch":
+        return model_class(model_name)
+    if BACKEND not in ("onnx", "onnx-int8"):
+        raise ValueError(f"Unknown BACKEND {BACKEND}")
+    export_dir = os.path.join(ONNX_CACHE_DIR, model_name.replace("/", "--"))
+    file_name = f"onnx/model_qint8_{ONNX_QUANTIZATION}.onnx" if BACKEND == "onnx-int8" else "onnx/model.onnx"
+    if not os.path.exists(os.path.join(export_dir, file_name)):
+        print(f"Exporting {model_name} to ONNX in {export_dir}...")
+        exported = model_class(model_name, backend="onnx")
+        exported.save_pretrained(export_dir)
+        if BACKEND == "onnx-int8":
+            export_dynamic_quantized_onnx_model(exported, ONNX_QUANTIZATION, export_dir)
+    return model_class(export_dir, backend="onnx", model_kwargs={"file_name": file_name})
@@ -0,0 +1,88 @@
+from qdrant_client import models
+
+# The ingestion job stores near-duplicate chunks once: the point belongs to the
+# document in its `metadata.doc_id` and lists every document containing the
+# chunk in `doc_ids`. Before the owner's chunks are pruned or deleted, its
+# shared chunks are handed over to the next document in `doc_ids`, so the
+# content of the other documents stays in the index.
+
+SCROLL_LIMIT = 256
+
+
+def scroll_points(qdrant_client, collection_name, scroll_filter):
+    """Yields the points matching `scroll_filter` with their metadata and doc_ids, page by page."""
+    offset = None
+    while True:
+        points, offset = qdrant_client.scroll(
+            collection_name=collection_name,
+            scroll_filter=scroll_filter,
+            limit=SCROLL_LIMIT,
+            offset=offset,
+            with_payload=["metadata", "doc_ids"],
+            with_vectors=False
+        )
+        yield from points
+        if offset is None:
+            return
+
+
+def heir_metadata(qdrant_client, collection_name, heir_id, metadata):
+    """
+    Returns the metadata for a chunk taken over by `heir_id`: the metadata of
+    one of the heir's own chunks, or the chunk's metadata with only the doc_id
+    replaced if the heir has no chunks of its own.
+    """
+    points, _ = qdrant_client.scroll(
+        collection_name=collection_name,
+        scroll_filter=models.Filter(must=[models.FieldCondition(key="metadata.doc_id", match=models.MatchValue(value=heir_id))]),
+        limit=1,
+        with_payload=["metadata"],
+        with_vectors=False
+    )
+    heir = dict(points[0].payload["metadata"]) if points else dict(metadata, doc_id=heir_id)
+    heir["chunk_index"] = metadata.get("chunk_index")
+    heir["chunk_hash"] = metadata.get("chunk_hash")
+    return heir
+
+
+def handover_operations(qdrant_client, collection_name, current_point_ids):
+    """
+    Returns the operations handing over the shared chunks that the documents
+    of `current_point_ids` (doc_id -> IDs of the points the document keeps)
+    own but no longer keep. They must run before the documents' stale chunks
+    are pruned, which then leaves the handed over chunks alone.
+    """
+    if not current_point_ids:
+        return []
+    kept = {doc_id: {str(point_id) for point_id in point_ids} for doc_id, point_ids in current_point_ids.items()}
+    shared_chunks = models.Filter(must=[
+        models.FieldCondition(key="metadata.doc_id", match=models.MatchAny(any=list(kept))),
+        models.FieldCondition(key="doc_ids", values_count=models.ValuesCount(gt=1)),
+    ])
+    operations = []
+    for point in scroll_points(qdrant_client, collection_name, shared_chunks):
+        metadata = point.payload["metadata"]
+        owner = metadata["doc_id"]
+        if str(point.id) in kept[owner]:
+            continue
+        others = [other for other in point.payload["doc_ids"] if other != owner]
+        payload = {"doc_ids": others, "metadata": heir_metadata(qdrant_client, collection_name, others[0], metadata)}
+        operations.append(models.SetPayloadOperation(set_payload=models.SetPayload(payload=payload, points=[point.id])))
+    return operations
+
+
+def release_operations(qdrant_client, collection_name, doc_id):
+    """
+    Returns the operations detaching a document that is about to be deleted
+    from the chunks it shares: the shared chunks it owns are handed over, and
+    it is removed from the `doc_ids` of the chunks other documents own.
+    """
+    operations = handover_operations(qdrant_client, collection_name, {doc_id: []})
+    listed_elsewhere = models.Filter(
+        must=[models.FieldCondition(key="doc_ids", match=models.MatchValue(value=doc_id))],
+        must_not=[models.FieldCondition(key="metadata.doc_id", match=models.MatchValue(value=doc_id))]
+    )
+    for point in scroll_points(qdrant_client, collection_name, listed_elsewhere):
+        others = [other for other in point.payload["doc_ids"] if other != doc_id]
+        operations.append(models.SetPayloadOperation(set_payload=models.SetPayload(payload={"doc_ids": others}, points=[point.id])))
+    return operations
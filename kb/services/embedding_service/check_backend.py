@@ -0,0 +1,68 @@
+"""
+Checks the configured BACKEND against the PyTorch model and benchmarks both on CPU.
+
+    BACKEND=onnx-int8 python check_backend.py [--texts FILE] [--count N]
+
+Parity is the cosine similarity between the vectors of both models for the
+same texts. Exits with status 1 if the lowest similarity is below --min-cosine.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+import embedding_app
+
+SAMPLE_TEXTS = [
+    "如何配置 Kubernetes 的水平自动伸缩 (HPA)？",
+    "The ingestion job failed because the embedding service returned 503.",
+    "首先需要安装 Metrics Server，然后为 Deployment 设置 CPU 请求值。",
+    "Qdrant stores one point per chunk with the document metadata as payload.",
+    "在 Confluence 中，代码宏的内容保存在 CDATA 段里。",
+    "Short query",
+]
+
+def benchmark(model, texts, batch_size):
+    """Returns (vectors, texts per second) of encoding `texts` once after a warm-up."""
+    model.encode(texts[:batch_size], batch_size=batch_size, normalize_embeddings=True)
+    started = time.perf_counter()
+    vectors = model.encode(texts, batch_size=batch_size, normalize_embeddings=True)
+    return vectors, len(texts) / (time.perf_counter() - started)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--texts", help="File with one text per line (default: built-in samples)")
+    parser.add_argument("--count", type=int, default=256, help="Number of texts to encode")
+    parser.add_argument("--batch-size", type=int, default=embedding_app.ENCODE_BATCH_SIZE)
+    parser.add_argument("--min-cosine", type=float, default=0.99)
+    args = parser.parse_args()
+
+    if args.texts:
+        with open(args.texts, encoding="utf-8") as f:
+            texts = [line.strip() for line in f if line.strip()]
+    else:
+        # Vary the lengths like real chunks
+        texts = [" ".join(SAMPLE_TEXTS[:1 + i % len(SAMPLE_TEXTS)]) for i in range(len(SAMPLE_TEXTS) * 4)]
+    texts = (texts * (args.count // len(texts) + 1))[:args.count]
+    cores = len(os.sched_getaffinity(0))
+
+    reference = SentenceTransformer(embedding_app.model_name, device="cpu")
+    reference_vectors, reference_rate = benchmark(reference, texts, args.batch_size)
+    vectors, rate = benchmark(embedding_app.model, texts, args.batch_size)
+
+    cosine = np.sum(reference_vectors * vectors, axis=1) # Both are normalized
+    print(f"Model: {embedding_app.model_name}, {len(texts)} texts, {cores} cores")
+    print(f"torch (cpu): {reference_rate:.1f} texts/s, {reference_rate / cores:.2f} texts/s per core")
+    print(f"{embedding_app.BACKEND}: {rate:.1f} texts/s, {rate / cores:.2f} texts/s per core "
+          f"({rate / reference_rate:.2f}x)")
+    print(f"Cosine similarity to torch: min {cosine.min():.5f}, mean {cosine.mean():.5f}")
+    if cosine.min() < args.min_cosine:
+        print(f"Parity check failed: minimum cosine similarity is below {args.min_cosine}.")
+        sys.exit(1)
+    print("Parity check passed.")
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,20 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Response
 from pydantic import BaseModel
 from sentence_transformers import SentenceTransformer
+from collections import Counter, OrderedDict
+import hashlib
 import os
+import threading
+
+import numpy as np
+
+from common.batching import MicroBatcher, PaddingStats
+from common.model_loading import BACKEND, load_model
+
+try:
+    import msgpack
+except ImportError: # Optional, the msgpack response format is unavailable
+    msgpack = None
 
 app = FastAPI()
 
@@ -11,16 +24,182 @@ class EmbedRequest(BaseModel):
 
 # Load the model from the environment variable
 model_name = os.getenv("MODEL_NAME", "BAAI/bge-large-zh-v1.5")
-model = SentenceTransformer(model_name)
+model = load_model(SentenceTransformer, model_name)
+
+# Concurrent requests are coalesced into one encode call of up to MAX_BATCH_SIZE
+# texts, waiting at most MAX_WAIT_MS for more requests after the first one.
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", 64))
+MAX_WAIT_MS = float(os.getenv("MAX_WAIT_MS", 5))
+# Texts per forward pass. encode sorts a call's texts by length before splitting
+# them into batches of this size, so each pass pads to similar lengths.
+ENCODE_BATCH_SIZE = int(os.getenv("ENCODE_BATCH_SIZE", 16))
+
+# In-process LRU cache of embeddings for repeated texts; 0 disables it
+EMBED_CACHE_MAX_MB = float(os.getenv("EMBED_CACHE_MAX_MB", 256))
+
+# Binary /embed response formats, selected with the Accept header. Raw formats
+# return the little-endian vectors row by row; the shape and dtype are sent in
+# the X-Embedding-Shape and X-Embedding-Dtype headers.
+RAW_MEDIA_TYPES = {
+    "application/x-float32": "float32",
+    "application/x-float16": "float16",
+}
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+
+padding_stats = PaddingStats()
+
+def tokenize_and_record_padding(texts, tokenize=model.tokenize):
+    """Tokenizes one forward pass of encode and records how much of it is padding."""
+    features = tokenize(texts)
+    if "attention_mask" in features:
+        lengths = features["attention_mask"].sum(dim=1).tolist()
+        padding_stats.record(lengths, [range(len(lengths))])
+    return features
+
+# encode tokenizes each of its batches through model.tokenize
+model.tokenize = tokenize_and_record_padding
+
+# Requests are grouped by normalize_embeddings, which applies to a whole encode call
+batcher = MicroBatcher(
+    lambda texts, normalize_embeddings: model.encode(
+        texts, normalize_embeddings=normalize_embeddings, batch_size=ENCODE_BATCH_SIZE
+    ),
+    MAX_BATCH_SIZE, MAX_WAIT_MS, item_name="texts"
+)
+
+class EmbeddingCache:
+    """
+    Memory-bounded LRU cache of embeddings keyed by (model, normalize flag,
+    sha256 of the text). Evicts the least recently used vectors once their
+    estimated size exceeds `max_bytes`. Thread-safe.
+    """
+
+    ENTRY_OVERHEAD_BYTES = 200 # Approximate size of the key, dict slot and array header
+
+    def __init__(self, max_bytes, model_id):
+        self.max_bytes = max_bytes
+        self.model_id = model_id
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+        self.stats = Counter()
+
+    def key(self, text, normalize_embeddings):
+        return (self.model_id, normalize_embeddings, hashlib.sha256(text.encode('utf-8')).digest())
+
+    def get(self, key):
+        with self.lock:
+            vector = self.entries.get(key)
+            if vector is None:
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return vector
+
+    def put(self, key, vector):
+        with self.lock:
+            if key in self.entries:
+                return
+            # Copy, since a row view would keep its whole batch array alive
+            vector = vector.copy()
+            self.entries[key] = vector
+            self.size_bytes += vector.nbytes + self.ENTRY_OVERHEAD_BYTES
+            while self.size_bytes > self.max_bytes and self.entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.size_bytes -= evicted.nbytes + self.ENTRY_OVERHEAD_BYTES
+                self.stats["evictions"] += 1
+
+    def summary(self):
+        with self.lock:
+            stats = dict(self.stats)
+            lookups = stats.get("hits", 0) + stats.get("misses", 0)
+            stats["hit_rate"] = round(stats.get("hits", 0) / lookups, 4) if lookups else 0
+            stats["entries"] = len(self.entries)
+            stats["memory_mb"] = round(self.size_bytes / 2**20, 2)
+            stats["max_memory_mb"] = round(self.max_bytes / 2**20, 2)
+            return stats
+
+embedding_cache = EmbeddingCache(int(EMBED_CACHE_MAX_MB * 2**20), f"{model_name}:{BACKEND}") if EMBED_CACHE_MAX_MB > 0 else None
+
+async def get_embeddings(texts, normalize_embeddings):
+    """Returns the embeddings of `texts` in order, only encoding the texts missing from the cache."""
+    if embedding_cache is None:
+        return await batcher.submit(texts, normalize_embeddings)
+    keys = [embedding_cache.key(text, normalize_embeddings) for text in texts]
+    vectors = [embedding_cache.get(key) for key in keys]
+    missing = {} # key -> text, each distinct text is encoded once
+    for key, text, vector in zip(keys, texts, vectors):
+        if vector is None:
+            missing.setdefault(key, text)
+    if missing:
+        encoded = await batcher.submit(list(missing.values()), normalize_embeddings)
+        fresh = dict(zip(missing.keys(), encoded))
+        for key, vector in fresh.items():
+            embedding_cache.put(key, vector)
+        vectors = [fresh[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+    return np.stack(vectors)
+
+def negotiate_media_type(accept):
+    """Returns the first supported media type listed in the Accept header, defaulting to JSON."""
+    for accepted in accept.split(","):
+        media_type = accepted.split(";")[0].strip().lower()
+        if media_type in RAW_MEDIA_TYPES or (media_type == MSGPACK_MEDIA_TYPE and msgpack is not None):
+            return media_type
+        if media_type == "application/json":
+            break
+    return "application/json"
+
+def embeddings_response(embeddings, media_type):
+    if media_type == "application/json":
+        return {"embeddings": embeddings.tolist(), "model_used": model_name}
+    if media_type == MSGPACK_MEDIA_TYPE:
+        vectors = embeddings.astype("<f4")
+        content = msgpack.packb({
+            "shape": list(vectors.shape),
+            "dtype": "float32",
+            "data": vectors.tobytes(),
+            "model_used": model_name,
+        })
+        return Response(content=content, media_type=media_type)
+    dtype = RAW_MEDIA_TYPES[media_type]
+    vectors = embeddings.astype(np.dtype(dtype).newbyteorder("<"))
+    return Response(
+        content=vectors.tobytes(),
+        media_type=media_type,
+        headers={
+            "X-Embedding-Shape": ",".join(str(n) for n in vectors.shape),
+            "X-Embedding-Dtype": dtype,
+            "X-Model-Used": model_name,
+        }
+    )
+
+@app.on_event("startup")
+async def start_batcher():
+    batcher.start()
 
 @app.post("/embed")
-def embed(request: EmbedRequest):
+async def embed(request: EmbedRequest, accept: str = Header("application/json")):
     try:
-        embeddings = model.encode(request.texts, normalize_embeddings=request.normalize_embeddings)
-        return {"embeddings": embeddings.tolist(), "model_used": model_name}
+        media_type = negotiate_media_type(accept)
+        if not request.texts:
+            embeddings = np.zeros((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+        else:
+            embeddings = await get_embeddings(request.texts, request.normalize_embeddings)
+        return embeddings_response(embeddings, media_type)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/stats")
+def stats():
+    """Returns micro-batching, padding and cache statistics."""
+    return {
+        "backend": BACKEND,
+        "batching": batcher.summary(),
+        "padding": padding_stats.summary(),
+        "cache": embedding_cache.summary() if embedding_cache is not None else None,
+    }
+
 @app.get("/health")
 def health():
     return {"status": "ok"}
@@ -1,29 +1,103 @@
 import os
+import io
 import requests
 import json
+import multiprocessing
 import uuid
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from datetime import datetime
+import gzip
+import hashlib
+import html
+import queue
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import zlib
+from collections import Counter, defaultdict, deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
+import numpy as np
 from qdrant_client import QdrantClient, models
 from minio import Minio
+from minio.error import S3Error
 from jira import JIRA
 from atlassian import Confluence
 from bs4 import BeautifulSoup
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
+try:
+    import zstandard
+except ImportError: # Optional, raw documents fall back to gzip
+    zstandard = None
+
+try:
+    import lxml
+except ImportError: # Optional, HTML falls back to the pure-Python parser
+    lxml = None
+
+from common.collection_generation import bump_generation
+from common.http_client import ServiceClient
+from common.shared_chunks import handover_operations, release_operations
+
 # --- Configuration ---
 # General
 EMBEDDING_SERVICE_URL = os.getenv("EMBEDDING_SERVICE_URL", "http://embedding-service:8000/embed")
 COLLECTION_NAME = "knowledge_base"
 EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 64))
-MAX_WORKERS = int(os.getenv("MAX_WORKERS", 10))
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", 4)) # Embedding requests in flight
+# Embeddings are transferred as raw float32/float16 buffers instead of JSON unless set to "json"
+EMBEDDING_RESPONSE_FORMAT = os.getenv("EMBEDDING_RESPONSE_FORMAT", "float32")
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", 10)) # Fetch workers, shared by all sources
+# HTML-to-text extraction runs in a process pool, so it isn't serialized by the GIL
+PARSE_PROCESSES = int(os.getenv("PARSE_PROCESSES", os.cpu_count() or 1)) # 0 parses in the calling thread
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", max(2, PARSE_PROCESSES)))
+HTML_PARSER = os.getenv("HTML_PARSER", "lxml" if lxml else "html.parser") # BeautifulSoup tree builder
+HTML_PROCESS_MIN_BYTES = int(os.getenv("HTML_PROCESS_MIN_BYTES", 16384)) # Smaller pages aren't worth the IPC
+CHUNK_WORKERS = int(os.getenv("CHUNK_WORKERS", 2))
+STAGE_QUEUE_SIZE = int(os.getenv("STAGE_QUEUE_SIZE", 100)) # Max items waiting in front of each stage
+
+# Embedding cache (persistent across runs when EMBEDDING_CACHE_PATH is on a volume)
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "/cache/embeddings.sqlite3") # Empty disables the cache
+EMBEDDING_CACHE_MAX_MB = int(os.getenv("EMBEDDING_CACHE_MAX_MB", 4096))
+EMBEDDING_CACHE_DTYPE = os.getenv("EMBEDDING_CACHE_DTYPE", "float16") # float16 or float32
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", 256)) # Points per Qdrant update
+UPSERT_CONCURRENCY = int(os.getenv("UPSERT_CONCURRENCY", 4)) # Qdrant updates in flight
 
 # MinIO
 MINIO_ENDPOINT = os.getenv("MINIO_ENDPOINT")
 MINIO_ACCESS_KEY = os.getenv("MINIO_ACCESS_KEY")
 MINIO_SECRET_KEY = os.getenv("MINIO_SECRET_KEY")
 MINIO_BUCKET = "raw-data"
+ARCHIVE_WORKERS = int(os.getenv("ARCHIVE_WORKERS", 4)) # Concurrent raw-document uploads
+ARCHIVE_COMPRESSION = os.getenv("ARCHIVE_COMPRESSION", "zstd") # zstd, gzip or none
+
+# Incremental ingestion state (watermarks and per-document content hashes)
+STATE_OBJECT_NAME = os.getenv("STATE_OBJECT_NAME", "_state/ingestion_state.json")
+# Document hash updates of the webhook receiver, merged into the state by the next run
+DOC_HASH_UPDATES_PREFIX = os.getenv("DOC_HASH_UPDATES_PREFIX", "_state/doc_hash_updates/")
+# Re-query this far back from the last watermark. Jira/Confluence interpret query
+# timestamps in the user's timezone, so the overlap must cover the UTC offset.
+INCREMENTAL_OVERLAP_HOURS = int(os.getenv("INCREMENTAL_OVERLAP_HOURS", 24))
+FULL_REINGEST = os.getenv("FULL_REINGEST", "false").lower() == "true"
+# The state, including resume checkpoints, is saved this often during a run
+CHECKPOINT_INTERVAL_SECONDS = int(os.getenv("CHECKPOINT_INTERVAL_SECONDS", 60))
+
+# Near-duplicate chunk detection (MinHash/LSH over character shingles)
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "true").lower() == "true"
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", 0.9)) # Estimated Jaccard similarity
+DEDUP_NUM_PERM = int(os.getenv("DEDUP_NUM_PERM", 64))
+DEDUP_BANDS = int(os.getenv("DEDUP_BANDS", 16))
+DEDUP_SHINGLE_SIZE = int(os.getenv("DEDUP_SHINGLE_SIZE", 5))
+DEDUP_MAX_MB = int(os.getenv("DEDUP_MAX_MB", 256)) # Memory of the index, about 1.5 KB per representative chunk
+MINHASH_PRIME = (1 << 31) - 1
+
+# Metrics
+PUSHGATEWAY_URL = os.getenv("PUSHGATEWAY_URL") # e.g. http://pushgateway:9091, unset disables pushing
+PUSHGATEWAY_JOB = os.getenv("PUSHGATEWAY_JOB", "kb-ingestion")
+QUEUE_SAMPLE_SECONDS = float(os.getenv("QUEUE_SAMPLE_SECONDS", 1))
 
 # Qdrant
 QDRANT_ENDPOINT = os.getenv("QDRANT_ENDPOINT")
@@ -33,18 +107,42 @@ JIRA_URL = os.getenv("JIRA_URL")
 JIRA_USERNAME = os.getenv("JIRA_USERNAME")
 JIRA_API_TOKEN = os.getenv("JIRA_API_TOKEN")
 JIRA_JQL = os.getenv("JIRA_JQL", "project = KB") # Example JQL
+# Bulk mode pages through search results with all needed fields instead of fetching each issue
+JIRA_BULK_FETCH = os.getenv("JIRA_BULK_FETCH", "true").lower() == "true"
+JIRA_PAGE_SIZE = int(os.getenv("JIRA_PAGE_SIZE", 100)) # Jira may cap this server-side
+JIRA_PAGE_CONCURRENCY = int(os.getenv("JIRA_PAGE_CONCURRENCY", 4))
+JIRA_FIELDS = "summary,description,comment,status,project,created,updated"
 
 # Confluence
 CONFLUENCE_URL = os.getenv("CONFLUENCE_URL")
 CONFLUENCE_USERNAME = os.getenv("CONFLUENCE_USERNAME")
 CONFLUENCE_API_TOKEN = os.getenv("CONFLUENCE_API_TOKEN")
 CONFLUENCE_SPACES = os.getenv("CONFLUENCE_SPACES", "KB,DOCS").split(',') # Comma-separated list of space keys
+CONFLUENCE_CQL = os.getenv("CONFLUENCE_CQL") # Optional, takes precedence over CONFLUENCE_SPACES
+CONFLUENCE_PAGE_SIZE = int(os.getenv("CONFLUENCE_PAGE_SIZE", 50)) # Confluence may cap this server-side
+CONFLUENCE_PAGE_CONCURRENCY = int(os.getenv("CONFLUENCE_PAGE_CONCURRENCY", 4))
+CONFLUENCE_PAGE_EXPAND = "body.storage,version,history,space"
+CONFLUENCE_SEARCH_EXPAND = ",".join(f"content.{field}" for field in CONFLUENCE_PAGE_EXPAND.split(","))
 
 # --- Clients ---
 qdrant_client = QdrantClient(host=QDRANT_ENDPOINT, port=6333)
 minio_client = Minio(MINIO_ENDPOINT, access_key=MINIO_ACCESS_KEY, secret_key=MINIO_SECRET_KEY, secure=False)
-jira_client = JIRA(server=JIRA_URL, basic_auth=(JIRA_USERNAME, JIRA_API_TOKEN))
+jira_client = None # Created by get_jira_client, since creating it connects to Jira
+jira_client_lock = threading.Lock()
 confluence_client = Confluence(url=CONFLUENCE_URL, username=CONFLUENCE_USERNAME, password=CONFLUENCE_API_TOKEN)
+embedding_client = ServiceClient(EMBEDDING_SERVICE_URL, max_concurrency=EMBEDDING_CONCURRENCY)
+
+def get_jira_client():
+    """Returns the Jira client, connecting on first use."""
+    global jira_client
+    with jira_client_lock:
+        if jira_client is None:
+            jira_client = JIRA(server=JIRA_URL, basic_auth=(JIRA_USERNAME, JIRA_API_TOKEN))
+        return jira_client
+
+# Point IDs are derived from (doc_id, chunk_index) so re-ingesting a document
+# overwrites its existing points instead of adding duplicates.
+CHUNK_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "knowledge-base/chunks")
 
 text_splitter = RecursiveCharacterTextSplitter(
     chunk_size=500,
@@ -52,211 +150,1414 @@ text_splitter = RecursiveCharacterTextSplitter(
     length_function=len,
 )
 
+class EmbeddingCache:
+    """
+    Persistent, content-addressed embedding cache stored in a SQLite file.
+
+    Keys are sha256(model name + normalized chunk text) and vectors are stored
+    as raw NumPy buffers of `dtype`. Once the stored vectors exceed `max_bytes`,
+    the least recently used entries are evicted. Safe to use from several threads.
+
+    `model_name` is the model the embedding service reported last, None until
+    its first response.
+    """
+
+    def __init__(self, path, max_bytes, dtype):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.model_name = None
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, dtype TEXT NOT NULL, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.size_bytes = self.conn.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+
+    def key(self, text, model_name):
+        normalized = " ".join(unicodedata.normalize("NFC", text).split())
+        return hashlib.sha256(f"{model_name}\0{normalized}".encode('utf-8')).hexdigest()
+
+    def get_many(self, keys):
+        """Returns {key: vector} for the keys found in the cache and refreshes their recency."""
+        unique_keys = list(set(keys))
+        found = {}
+        with self.lock:
+            for start in range(0, len(unique_keys), 500): # Stay below SQLite's variable limit
+                batch = unique_keys[start:start + 500]
+                rows = self.conn.execute(
+                    f"SELECT key, dtype, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                for key, dtype, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=dtype).astype(np.float32).tolist()
+            if found:
+                now = time.time()
+                self.conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+                self.conn.commit()
+            hits = sum(1 for key in keys if key in found)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return found
+
+    def put_many(self, entries):
+        """Stores {key: vector} entries and evicts the least recently used ones if over budget."""
+        now = time.time()
+        rows = [
+            (key, self.dtype.str, np.asarray(vector, dtype=self.dtype).tobytes(), now)
+            for key, vector in entries.items()
+        ]
+        with self.lock:
+            for key, _, vector, _ in rows:
+                previous = self.conn.execute("SELECT LENGTH(vector) FROM embeddings WHERE key = ?", (key,)).fetchone()
+                self.size_bytes += len(vector) - (previous[0] if previous else 0)
+            self.conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+            if self.size_bytes > self.max_bytes:
+                self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        # Evict down to 90% of the budget so eviction doesn't run on every insert
+        target = int(self.max_bytes * 0.9)
+        cursor = self.conn.execute("SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_used")
+        evicted = []
+        for key, length in cursor:
+            if self.size_bytes <= target:
+                break
+            evicted.append((key,))
+            self.size_bytes -= length
+        cursor.close()
+        self.conn.executemany("DELETE FROM embeddings WHERE key = ?", evicted)
+        print(f"Evicted {len(evicted)} entries from the embedding cache.")
+
+    def stats(self):
+        """Returns the hit/miss counters of this run and the stored size."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "stored_mb": round(self.size_bytes / 2**20, 1),
+        }
+
+def open_embedding_cache():
+    """Opens the embedding cache, or returns None if it is disabled or unavailable."""
+    if not EMBEDDING_CACHE_PATH:
+        return None
+    try:
+        return EmbeddingCache(EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_MB * 2**20, EMBEDDING_CACHE_DTYPE)
+    except Exception as e:
+        print(f"Embedding cache unavailable, continuing without it: {e}")
+        return None
+
+embedding_cache = open_embedding_cache()
+
+def request_embeddings(texts):
+    """
+    Calls the embedding service for one batch of texts, retrying transient failures.
+    Returns (embeddings, model the service reported), or (None, None) on failure.
+    """
+    try:
+        if EMBEDDING_RESPONSE_FORMAT == "json":
+            return decode_embeddings(embedding_client.post(json={"texts": texts}))
+        # Services without binary support answer with JSON
+        accept = f"application/x-{EMBEDDING_RESPONSE_FORMAT}, application/json;q=0.5"
+        return decode_embeddings(embedding_client.post(json={"texts": texts}, headers={"Accept": accept}))
+    except requests.RequestException as e:
+        print(f"Error calling embedding service: {e}")
+        return None, None
+
+def decode_embeddings(response):
+    """
+    Decodes a JSON or raw little-endian /embed response into a list of float32
+    vectors and the name of the model that produced them (None if not reported).
+    """
+    if response.headers.get("Content-Type", "").startswith("application/json"):
+        body = response.json()
+        return body["embeddings"], body.get("model_used")
+    shape = tuple(int(n) for n in response.headers["X-Embedding-Shape"].split(","))
+    dtype = np.dtype(response.headers["X-Embedding-Dtype"]).newbyteorder("<")
+    # Qdrant points take plain lists; tolist() builds them in C without parsing text
+    embeddings = np.frombuffer(response.content, dtype=dtype).reshape(shape).astype(np.float32).tolist()
+    return embeddings, response.headers.get("X-Model-Used")
+
 def get_embeddings(texts):
-    """Calls the embedding service in batches."""
+    """
+    Returns embeddings for one batch of texts, only sending cache misses to the
+    embedding service. Cached vectors are keyed by the model the service
+    reports, so vectors of a previously deployed model are never mixed in.
+    """
+    model_name = embedding_cache.model_name if embedding_cache is not None else None
+    if model_name is None:
+        embeddings, model_used = request_embeddings(texts)
+        if embeddings and embedding_cache is not None and model_used:
+            embedding_cache.put_many({embedding_cache.key(text, model_used): vector for text, vector in zip(texts, embeddings)})
+            embedding_cache.model_name = model_used
+        return embeddings
+
+    keys = [embedding_cache.key(text, model_name) for text in texts]
+    vectors = embedding_cache.get_many(keys)
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in vectors:
+            missing.setdefault(key, text)
+    if missing:
+        fresh, model_used = request_embeddings(list(missing.values()))
+        if not fresh:
+            return None
+        if model_used != model_name:
+            # The service now runs another model; look the batch up again under it
+            print(f"Embedding service switched from model {model_name} to {model_used}.")
+            embedding_cache.model_name = model_used
+            return get_embeddings(texts)
+        fresh = dict(zip(missing.keys(), fresh))
+        embedding_cache.put_many(fresh)
+        vectors.update(fresh)
+    return [vectors[key] for key in keys]
+
+class RunMetrics:
+    """
+    Thread-safe per-stage instrumentation for one ingestion run: busy time,
+    calls, items and bytes per stage, plus sampled queue depths.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.stages = defaultdict(Counter) # stage -> calls, seconds, items, bytes
+        self.queues = defaultdict(Counter) # stage -> samples, total, max
+
+    @contextmanager
+    def timed(self, stage, items=1, nbytes=0):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started, items, nbytes)
+
+    def record(self, stage, seconds, items=1, nbytes=0):
+        with self.lock:
+            counters = self.stages[stage]
+            counters["calls"] += 1
+            counters["seconds"] += seconds
+            counters["items"] += items
+            counters["bytes"] += nbytes
+
+    def add_bytes(self, stage, nbytes):
+        with self.lock:
+            self.stages[stage]["bytes"] += nbytes
+
+    def sample_queue(self, stage, depth):
+        with self.lock:
+            counters = self.queues[stage]
+            counters["samples"] += 1
+            counters["total"] += depth
+            counters["max"] = max(counters["max"], depth)
+
+    def summary(self):
+        """Returns the run's per-stage timings, throughputs and queue depths as a JSON-serializable dict."""
+        duration = time.time() - self.started
+        with self.lock:
+            stages = {
+                stage: {
+                    "calls": counters["calls"],
+                    "items": counters["items"],
+                    "bytes": counters["bytes"],
+                    "busy_seconds": round(counters["seconds"], 3),
+                    "avg_ms": round(counters["seconds"] / counters["calls"] * 1000, 2) if counters["calls"] else 0.0,
+                    "items_per_sec": round(counters["items"] / duration, 2) if duration else 0.0,
+                }
+                for stage, counters in self.stages.items()
+            }
+            queues = {
+                stage: {
+                    "avg_depth": round(counters["total"] / counters["samples"], 2) if counters["samples"] else 0.0,
+                    "max_depth": counters["max"],
+                }
+                for stage, counters in self.queues.items()
+            }
+        return {
+            "started": datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+            "duration_seconds": round(duration, 3),
+            "stages": stages,
+            "queues": queues,
+        }
+
+metrics = RunMetrics()
+
+def push_metrics(summary):
+    """Pushes the run summary to a Prometheus Pushgateway-compatible endpoint, if configured."""
+    if not PUSHGATEWAY_URL:
+        return
+    lines = []
+
+    def gauge(name, value, **labels):
+        label_str = ",".join(f'{key}="{value}"' for key, value in labels.items())
+        lines.append(f"kb_ingestion_{name}{{{label_str}}} {value}" if labels else f"kb_ingestion_{name} {value}")
+
+    gauge("run_duration_seconds", summary["duration_seconds"])
+    gauge("documents_per_second", summary["documents_per_second"])
+    gauge("chunks_per_second", summary["chunks_per_second"])
+    gauge("http_retries", summary["http_retries"])
+    for stage, stats in summary["stages"].items():
+        gauge("stage_busy_seconds", stats["busy_seconds"], stage=stage)
+        gauge("stage_items", stats["items"], stage=stage)
+        gauge("stage_bytes", stats["bytes"], stage=stage)
+        gauge("stage_avg_ms", stats["avg_ms"], stage=stage)
+    for stage, stats in summary["queues"].items():
+        gauge("queue_depth_avg", stats["avg_depth"], stage=stage)
+        gauge("queue_depth_max", stats["max_depth"], stage=stage)
+    for source, stats in summary["sources"].items():
+        for outcome, count in stats.items():
+            gauge("documents", count, source=source, outcome=outcome)
     try:
-        response = requests.post(EMBEDDING_SERVICE_URL, json={"texts": texts})
+        response = requests.put(
+            f"{PUSHGATEWAY_URL.rstrip('/')}/metrics/job/{PUSHGATEWAY_JOB}",
+            data="\n".join(lines) + "\n",
+            headers={"Content-Type": "text/plain; version=0.0.4"},
+            timeout=10,
+        )
         response.raise_for_status()
-        return response.json()["embeddings"]
     except requests.RequestException as e:
-        print(f"Error calling embedding service: {e}")
-        return None
+        print(f"Error pushing metrics to {PUSHGATEWAY_URL}: {e}")
+
+def compress(data):
+    """Compresses bytes with ARCHIVE_COMPRESSION and returns (bytes, content_encoding)."""
+    if ARCHIVE_COMPRESSION == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor(level=3).compress(data), "zstd"
+    if ARCHIVE_COMPRESSION in ("zstd", "gzip"):
+        return gzip.compress(data, compresslevel=6), "gzip"
+    return data, None
+
+def archive_document(doc):
+    """
+    Uploads a raw document to MinIO as compact, compressed JSON, unless the
+    stored object already has the same content hash. Returns True if uploaded.
+    """
+    object_name = f"{doc['metadata']['doc_id']}.json"
+    content_bytes = json.dumps(doc, ensure_ascii=False, separators=(',', ':'), sort_keys=True).encode('utf-8')
+    content_hash = hashlib.sha256(content_bytes).hexdigest()
+    try:
+        stored = minio_client.stat_object(MINIO_BUCKET, object_name)
+        if stored.metadata.get("x-amz-meta-content-sha256") == content_hash:
+            return False
+    except S3Error as e:
+        if e.code != "NoSuchKey":
+            raise
+
+    data, content_encoding = compress(content_bytes)
+    metrics.add_bytes("archive", len(data))
+    metadata = {"content-sha256": content_hash}
+    if content_encoding:
+        metadata["Content-Encoding"] = content_encoding
+    minio_client.put_object(
+        MINIO_BUCKET,
+        object_name,
+        data=io.BytesIO(data),
+        length=len(data),
+        content_type='application/json',
+        metadata=metadata
+    )
+    return True
+
+def load_state():
+    """Loads the incremental ingestion state from MinIO, or returns an empty state."""
+    empty_state = {"sources": {}}
+    if FULL_REINGEST:
+        print("FULL_REINGEST is set. Ignoring stored ingestion state.")
+        return empty_state
+    response = None
+    try:
+        response = minio_client.get_object(MINIO_BUCKET, STATE_OBJECT_NAME)
+        state = json.loads(response.read().decode('utf-8'))
+        state.setdefault("sources", {})
+        return state
+    except Exception as e:
+        print(f"No usable ingestion state found ({e}). Running a full ingestion.")
+        return empty_state
+    finally:
+        if response is not None:
+            response.close()
+            response.release_conn()
+
+def serialize_state(state):
+    return json.dumps(state, ensure_ascii=False).encode('utf-8')
+
+def save_state(state):
+    """Persists the incremental ingestion state to MinIO. Returns True on success."""
+    return store_state(serialize_state(state))
 
-def upload_to_minio(doc_id, content):
-    """Uploads raw content to MinIO."""
+def store_state(state_bytes):
+    """Writes serialized ingestion state to MinIO. Returns True on success."""
     try:
-        content_json = json.dumps(content, indent=2, ensure_ascii=False)
-        content_bytes = content_json.encode('utf-8')
         minio_client.put_object(
             MINIO_BUCKET,
-            doc_id,
-            data=io.BytesIO(content_bytes),
-            length=len(content_bytes),
+            STATE_OBJECT_NAME,
+            data=io.BytesIO(state_bytes),
+            length=len(state_bytes),
             content_type='application/json'
         )
+        return True
     except Exception as e:
-        print(f"Error uploading to MinIO for doc {doc_id}: {e}")
+        print(f"Error saving ingestion state: {e}")
+        return False
 
+def record_doc_hash(source, doc_id, doc_hash):
+    """
+    Records the content hash of a document ingested outside of a batch run, or
+    that it was deleted if `doc_hash` is None, so the next run skips the
+    document only if it is unchanged. Every update is a separate object that
+    the next run merges into its state, so it never races with the state writes
+    of a run in progress.
+    """
+    data = json.dumps({"source": source, "doc_id": doc_id, "doc_hash": doc_hash}).encode('utf-8')
+    # Names sort by time, so updates are merged in the order they were recorded
+    object_name = f"{DOC_HASH_UPDATES_PREFIX}{time.time_ns():020d}-{uuid.uuid4().hex}.json"
+    minio_client.put_object(
+        MINIO_BUCKET,
+        object_name,
+        data=io.BytesIO(data),
+        length=len(data),
+        content_type='application/json'
+    )
 
-def process_and_upload_documents(documents):
+def merge_doc_hash_updates(state):
     """
-    Processes a list of document dictionaries, chunks text, gets embeddings,
-    and uploads to Qdrant and MinIO in batches for efficiency.
+    Applies the updates recorded by record_doc_hash to `state`, oldest first.
+    Returns the names of the merged update objects, to be removed once the
+    state is saved; updates recorded in the meantime are left for the next run.
     """
-    points_to_upload = []
-    
-    for doc in documents:
-        doc_id = doc['metadata']['doc_id']
-        
-        # Upload raw document to MinIO
-        upload_to_minio(f"{doc_id}.json", doc)
+    try:
+        names = sorted(
+            obj.object_name for obj in minio_client.list_objects(MINIO_BUCKET, prefix=DOC_HASH_UPDATES_PREFIX, recursive=True)
+        )
+    except Exception as e:
+        print(f"Error listing document hash updates: {e}")
+        return []
+    merged = []
+    for name in names:
+        response = None
+        try:
+            response = minio_client.get_object(MINIO_BUCKET, name)
+            update = json.loads(response.read().decode('utf-8'))
+        except Exception as e:
+            # Later updates of the same document must not be applied before this one
+            print(f"Error reading document hash update {name}, merging the rest next run: {e}")
+            break
+        finally:
+            if response is not None:
+                response.close()
+                response.release_conn()
+        # A full re-ingestion rebuilds all hashes, so the updates are only dropped
+        if not FULL_REINGEST:
+            doc_hashes = state["sources"].setdefault(update["source"], {}).setdefault("doc_hashes", {})
+            if update["doc_hash"] is None:
+                doc_hashes.pop(update["doc_id"], None)
+            else:
+                doc_hashes[update["doc_id"]] = update["doc_hash"]
+        merged.append(name)
+    if merged:
+        print(f"Merged {len(merged)} document hash updates recorded outside of batch runs.")
+    return merged
 
-        # Chunk the text
-        chunks = text_splitter.split_text(doc['text'])
-        
-        if not chunks:
-            continue
+def remove_doc_hash_updates(names):
+    for name in names:
+        try:
+            minio_client.remove_object(MINIO_BUCKET, name)
+        except Exception as e:
+            print(f"Error removing document hash update {name}: {e}")
 
-        # Get embeddings for all chunks of the document in one go
-        embeddings = get_embeddings(chunks)
-        if not embeddings:
-            print(f"Skipping document {doc_id} due to embedding failure.")
-            continue
-
-        # Create Qdrant points
-        for i, chunk in enumerate(chunks):
-            point_id = str(uuid.uuid4())
-            
-            metadata = doc['metadata'].copy()
-            metadata['chunk_index'] = i
-            
-            points_to_upload.append(
-                models.PointStruct(
-                    id=point_id,
-                    vector=embeddings[i],
-                    payload={
-                        "text": chunk,
-                        "metadata": metadata
-                    }
-                )
+def compute_doc_hash(doc):
+    """Hashes the parts of a document that end up in Qdrant, ignoring the 'updated' timestamp."""
+    metadata = {k: v for k, v in doc['metadata'].items() if k != 'updated'}
+    canonical = json.dumps({"text": doc['text'], "metadata": metadata}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def query_since(source_state):
+    """Returns the lower bound for an incremental query, or None for a full ingestion."""
+    watermark = source_state.get("watermark")
+    if not watermark:
+        return None
+    return datetime.fromisoformat(watermark) - timedelta(hours=INCREMENTAL_OVERLAP_HOURS)
+
+
+def chunk_point_id(doc_id, chunk_index):
+    """Returns the deterministic Qdrant point ID of a document chunk."""
+    return str(uuid.uuid5(CHUNK_ID_NAMESPACE, f"{doc_id}#{chunk_index}"))
+
+def stale_chunks_operation(doc_id, current_point_ids):
+    """Builds a delete operation for all points of a document that are not in `current_point_ids`."""
+    return models.DeleteOperation(
+        delete=models.FilterSelector(
+            filter=models.Filter(
+                must=[
+                    models.FieldCondition(
+                        key="metadata.doc_id",
+                        match=models.MatchValue(value=doc_id)
+                    )
+                ],
+                must_not=[models.HasIdCondition(has_id=current_point_ids)] if current_point_ids else None
             )
+        )
+    )
+
+class QdrantBatchWriter:
+    """
+    Buffers Qdrant update operations and flushes them in batches of about
+    `batch_size` points, with at most `max_in_flight` updates running at once.
+
+    `add_document` is thread-safe and blocks while all upload slots are busy,
+    which applies back-pressure to the producers and keeps memory bounded. A document's
+    points are never split across batches, so a successful batch means its
+    documents are fully stored. `on_batch_done(documents, success)` is called
+    with the (tag, doc_id, doc_hash) tuples of every finished batch. Stale chunks
+    that other documents still share are handed over to them instead of pruned.
+    """
+
+    def __init__(self, on_batch_done, batch_size=UPSERT_BATCH_SIZE, max_in_flight=UPSERT_CONCURRENCY):
+        self.on_batch_done = on_batch_done
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.lock = threading.Lock()
+        self.buffer_lock = threading.Lock()
+        self.points_uploaded = 0
+        self._reset_batch()
+
+    def _reset_batch(self):
+        self.points = []
+        self.current_point_ids = {}
+        self.stale_chunk_operations = []
+        self.documents = []
 
-    # Batch upload points to Qdrant
-    if points_to_upload:
-        print(f"Uploading {len(points_to_upload)} points to Qdrant...")
+    def add_document(self, tag, doc_id, doc_hash, points):
+        """Queues a document's points and the pruning of its stale chunks. `tag` is passed back to on_batch_done."""
+        with self.buffer_lock:
+            self.points.extend(points)
+            self.current_point_ids[doc_id] = [point.id for point in points]
+            self.stale_chunk_operations.append(stale_chunks_operation(doc_id, self.current_point_ids[doc_id]))
+            self.documents.append((tag, doc_id, doc_hash))
+            if len(self.points) >= self.batch_size:
+                self._flush()
+
+    def flush(self):
+        """Submits the buffered operations as one Qdrant update."""
+        with self.buffer_lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.documents:
+            return
+        # Deletes run after the upsert, so a document is never left without points.
+        update_operations = []
+        if self.points:
+            update_operations.append(models.UpsertOperation(upsert=models.PointsList(points=self.points)))
+        stale_chunk_operations, current_point_ids = self.stale_chunk_operations, self.current_point_ids
+        documents, point_count = self.documents, len(self.points)
+        self._reset_batch()
+
+        self.slots.acquire()
+        future = self.executor.submit(
+            self._upload, update_operations, current_point_ids, stale_chunk_operations, documents, point_count
+        )
+        future.add_done_callback(lambda _: self.slots.release())
+
+    def _upload(self, update_operations, current_point_ids, stale_chunk_operations, documents, point_count):
         try:
-            qdrant_client.upsert(
-                collection_name=COLLECTION_NAME,
-                points=points_to_upload,
-                wait=True
-            )
+            with metrics.timed("upsert", items=point_count):
+                update_operations += handover_operations(qdrant_client, COLLECTION_NAME, current_point_ids)
+                update_operations += stale_chunk_operations
+                qdrant_client.batch_update_points(
+                    collection_name=COLLECTION_NAME,
+                    update_operations=update_operations,
+                    wait=True
+                )
         except Exception as e:
-            print(f"Error uploading points to Qdrant: {e}")
+            print(f"Error uploading {point_count} points for {len(documents)} documents to Qdrant: {e}")
+            self.on_batch_done(documents, False)
+            return
+        with self.lock:
+            self.points_uploaded += point_count
+        self.on_batch_done(documents, True)
 
-def fetch_jira_issue(issue_key):
-    """Fetches a single Jira issue and formats it."""
-    try:
-        issue = jira_client.issue(issue_key, expand="changelog")
-        
-        content = [issue.fields.summary, issue.fields.description or ""]
-        for comment in issue.fields.comment.comments:
-            content.append(comment.body)
+    def close(self):
+        """Flushes the remaining operations and waits for all uploads."""
+        self.flush()
+        self.executor.shutdown(wait=True)
+
+class EmbeddingBatcher:
+    """
+    Packs chunks from many documents into embedding requests of exactly
+    `batch_size` texts (except the last) and keeps up to `max_in_flight`
+    requests running concurrently.
+
+    Each document is registered with `add(item, texts)`, which is thread-safe.
+    Once every one of its chunks has been embedded, `on_embedded(item, embeddings)`
+    is called from a worker thread with the vectors in chunk order, or with
+    None if any of its requests failed. `add` blocks while all request slots are busy.
+    """
+
+    def __init__(self, on_embedded, batch_size=EMBEDDING_BATCH_SIZE, max_in_flight=EMBEDDING_CONCURRENCY):
+        self.on_embedded = on_embedded
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.lock = threading.Lock()
+        self.pending_lock = threading.Lock()
+        self.pending = [] # (entry, chunk_index, text) not yet sent
+
+    def add(self, item, texts):
+        """Queues the texts of one document for embedding."""
+        entry = {"item": item, "embeddings": [None] * len(texts), "remaining": len(texts), "failed": False}
+        with self.pending_lock:
+            self.pending.extend((entry, i, text) for i, text in enumerate(texts))
+            while len(self.pending) >= self.batch_size:
+                self._submit(self.pending[:self.batch_size])
+                self.pending = self.pending[self.batch_size:]
+
+    def _submit(self, batch):
+        self.slots.acquire()
+        future = self.executor.submit(self._embed, batch)
+        future.add_done_callback(lambda _: self.slots.release())
+
+    def _embed(self, batch):
+        texts = [text for _, _, text in batch]
+        try:
+            with metrics.timed("embed", items=len(texts), nbytes=sum(len(text.encode('utf-8')) for text in texts)):
+                embeddings = get_embeddings(texts)
+        except Exception as e:
+            # E.g. an undecodable response or a full cache disk; nothing may escape into the future
+            print(f"Error embedding a batch of {len(texts)} chunks: {e}")
+            embeddings = None
+        if not embeddings or len(embeddings) != len(batch):
+            embeddings = None
+        completed = []
+        with self.lock:
+            for n, (entry, chunk_index, _) in enumerate(batch):
+                if embeddings is None:
+                    entry["failed"] = True
+                else:
+                    entry["embeddings"][chunk_index] = embeddings[n]
+                entry["remaining"] -= 1
+                if entry["remaining"] == 0:
+                    completed.append(entry)
+        for entry in completed:
+            embeddings = None if entry["failed"] else entry["embeddings"]
+            try:
+                self.on_embedded(entry["item"], embeddings)
+            except Exception as e:
+                print(f"Error handling embedded chunks: {e}")
+                if embeddings is not None:
+                    self.on_embedded(entry["item"], None) # Reports the document as failed
+
+    def close(self):
+        """Sends the last partial batch and waits for all requests."""
+        with self.pending_lock:
+            if self.pending:
+                self._submit(self.pending)
+                self.pending = []
+        self.executor.shutdown(wait=True)
+
+class Stage:
+    """
+    A pool of `workers` threads applying `fn` to items taken from a bounded
+    queue. `put` blocks while the queue is full, so a slow stage throttles
+    the stages that feed it.
+    """
+
+    _STOP = object()
+
+    def __init__(self, name, fn, workers, queue_size=STAGE_QUEUE_SIZE):
+        self.name = name
+        self.fn = fn
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.threads = [
+            threading.Thread(target=self._work, name=f"{name}-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is self._STOP:
+                return
+            self.fn(item)
+
+    def close(self):
+        """Waits until all queued items are processed and stops the workers."""
+        for _ in self.threads:
+            self.queue.put(self._STOP)
+        for thread in self.threads:
+            thread.join()
+
+class NearDuplicateIndex:
+    """
+    In-memory MinHash/LSH index over the chunks of one ingestion run.
+
+    Every representative chunk is stored with a MinHash signature over the
+    character shingles of its normalized text, bucketed into `bands` LSH bands.
+    A chunk whose estimated Jaccard similarity to a bucket-mate reaches
+    `threshold` is reported as a near-duplicate of that representative, and
+    its document is recorded as a dependent of the representative's owner.
+
+    Signatures, point IDs and owners live in NumPy arrays that grow up to
+    `max_bytes` worth of representatives (see ENTRY_BYTES); later chunks are
+    still matched but no longer registered. Thread-safe.
+    """
+
+    def __init__(self, num_perm=DEDUP_NUM_PERM, bands=DEDUP_BANDS, threshold=DEDUP_THRESHOLD,
+                 shingle_size=DEDUP_SHINGLE_SIZE, max_bytes=DEDUP_MAX_MB * 2**20):
+        # A fixed seed keeps signatures comparable between workers and runs
+        rng = np.random.default_rng(42)
+        self.a = rng.integers(1, MINHASH_PRIME, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, MINHASH_PRIME, num_perm, dtype=np.uint64)
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.max_entries = max(1, max_bytes // self.entry_bytes(num_perm, bands))
+        self.lock = threading.Lock()
+        self.size = 0
+        self.signatures = np.zeros((0, num_perm), dtype=np.uint32)
+        self.point_ids = np.zeros((0, 16), dtype=np.uint8) # UUID bytes
+        self.owner_rows = np.zeros(0, dtype=np.uint32)
+        self.owners = [] # (source, doc_id), one per document
+        self.owner_index = {}
+        self.buckets = {} # band hash -> row, or list of rows on collisions
+        self.dependents = defaultdict(set) # row -> {(source, doc_id)} of other documents
+
+    @staticmethod
+    def entry_bytes(num_perm, bands):
+        """Approximate memory per representative: its arrays plus one bucket dict entry and int key per band."""
+        return num_perm * 4 + 16 + 4 + bands * 80
+
+    def signature(self, text):
+        normalized = " ".join(text.lower().split())
+        k = self.shingle_size
+        shingles = {normalized[i:i + k] for i in range(max(1, len(normalized) - k + 1))}
+        hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+        hashes %= MINHASH_PRIME
+        return ((np.outer(self.a, hashes) + self.b[:, None]) % MINHASH_PRIME).min(axis=1).astype(np.uint32)
+
+    def _grow(self):
+        capacity = min(self.max_entries, max(1024, 2 * len(self.signatures)))
+        self.signatures = np.concatenate([self.signatures, np.zeros((capacity - len(self.signatures), self.signatures.shape[1]), dtype=np.uint32)])
+        self.point_ids = np.concatenate([self.point_ids, np.zeros((capacity - len(self.point_ids), 16), dtype=np.uint8)])
+        self.owner_rows = np.concatenate([self.owner_rows, np.zeros(capacity - len(self.owner_rows), dtype=np.uint32)])
+
+    def find_or_add(self, text, point_id, owner):
+        """
+        Returns the point ID of the representative `text` is a near-duplicate
+        of, or None after registering `text` as a new representative.
+        """
+        signature = self.signature(text)
+        # One int per band; a colliding hash only costs an extra signature comparison
+        band_keys = [hash((band, signature[band * self.rows:(band + 1) * self.rows].tobytes())) for band in range(self.bands)]
+        with self.lock:
+            for band_key in band_keys:
+                candidates = self.buckets.get(band_key, ())
+                for row in (candidates,) if isinstance(candidates, int) else candidates:
+                    if np.mean(self.signatures[row] == signature) >= self.threshold:
+                        if self.owners[self.owner_rows[row]] != owner:
+                            self.dependents[row].add(owner)
+                        return str(uuid.UUID(bytes=self.point_ids[row].tobytes()))
+            if self.size >= self.max_entries:
+                return None
+            if self.size == len(self.signatures):
+                self._grow()
+            row = self.size
+            self.size += 1
+            self.signatures[row] = signature
+            self.point_ids[row] = np.frombuffer(uuid.UUID(point_id).bytes, dtype=np.uint8)
+            if owner not in self.owner_index:
+                self.owner_index[owner] = len(self.owners)
+                self.owners.append(owner)
+            self.owner_rows[row] = self.owner_index[owner]
+            for band_key in band_keys:
+                bucket = self.buckets.get(band_key)
+                if bucket is None:
+                    self.buckets[band_key] = row
+                elif isinstance(bucket, int):
+                    self.buckets[band_key] = [bucket, row]
+                else:
+                    bucket.append(row)
+        return None
+
+    def shared_points(self):
+        """Yields (point_id, owner, dependents) for every representative that other documents depend on."""
+        with self.lock:
+            for row, dependents in self.dependents.items():
+                yield str(uuid.UUID(bytes=self.point_ids[row].tobytes())), self.owners[self.owner_rows[row]], sorted(dependents)
+
+def build_points(doc, chunks, embeddings, chunk_indices=None):
+    """
+    Creates the Qdrant points for the chunks of a document. `chunk_indices`
+    gives each chunk's position in the document when near-duplicates were left out.
+    """
+    doc_id = doc['metadata']['doc_id']
+    if chunk_indices is None:
+        chunk_indices = range(len(chunks))
+    points = []
+    for i, chunk, embedding in zip(chunk_indices, chunks, embeddings):
+        point_id = chunk_point_id(doc_id, i)
         
-        text_content = "\n\n".join(filter(None, content))
+        metadata = doc['metadata'].copy()
+        metadata['chunk_index'] = i
+        metadata['chunk_hash'] = hashlib.sha256(chunk.encode('utf-8')).hexdigest()
         
-        return {
-            "text": text_content,
-            "metadata": {
-                "doc_id": f"jira-{issue.key}",
-                "source": "jira",
-                "title": issue.fields.summary,
-                "url": issue.permalink(),
-                "created": issue.fields.created,
-                "updated": issue.fields.updated,
-                "project": issue.fields.project.key,
-                "status": issue.fields.status.name,
-            }
-        }
-    except Exception as e:
-        print(f"Failed to fetch Jira issue {issue_key}: {e}")
-        return None
+        points.append(
+            models.PointStruct(
+                id=point_id,
+                vector=embedding,
+                payload={
+                    "text": chunk,
+                    "metadata": metadata,
+                    # All documents containing this chunk, extended for near-duplicates after the run
+                    "doc_ids": [doc_id]
+                }
+            )
+        )
+    return points
 
-def ingest_jira():
-    """Ingests data from Jira using parallel fetching."""
-    print("Starting Jira ingestion...")
-    issues = jira_client.search_issues(JIRA_JQL, maxResults=False, fields="key")
-    issue_keys = [issue.key for issue in issues]
-    print(f"Found {len(issue_keys)} issues in Jira.")
-
-    documents = []
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        future_to_issue = {executor.submit(fetch_jira_issue, key): key for key in issue_keys}
-        for future in as_completed(future_to_issue):
-            result = future.result()
-            if result:
-                documents.append(result)
-    
-    print(f"Successfully fetched {len(documents)} issues. Processing and uploading...")
-    process_and_upload_documents(documents)
-    print("Jira ingestion finished.")
+def ingest_document(doc):
+    """
+    Chunks, embeds and stores a single document right away, replacing its
+    existing chunks, and archives it. Returns the number of points stored.
+    Near-duplicate detection is skipped, so the document keeps all its chunks.
+    """
+    doc_id = doc['metadata']['doc_id']
+    with metrics.timed("chunk"):
+        chunks = text_splitter.split_text(doc['text'])
+    embeddings = []
+    if chunks:
+        with metrics.timed("embed", items=len(chunks)):
+            embeddings = get_embeddings(chunks)
+        if not embeddings or len(embeddings) != len(chunks):
+            raise RuntimeError(f"Embedding failed for document {doc_id}")
+    points = build_points(doc, chunks, embeddings)
 
+    point_ids = [point.id for point in points]
+    update_operations = []
+    if points:
+        update_operations.append(models.UpsertOperation(upsert=models.PointsList(points=points)))
+    update_operations.extend(handover_operations(qdrant_client, COLLECTION_NAME, {doc_id: point_ids}))
+    update_operations.append(stale_chunks_operation(doc_id, point_ids))
+    with metrics.timed("upsert", items=len(points)):
+        qdrant_client.batch_update_points(
+            collection_name=COLLECTION_NAME,
+            update_operations=update_operations,
+            wait=True
+        )
+
+    bump_generation(minio_client, MINIO_BUCKET, f"ingest {doc_id}")
 
-def fetch_confluence_page(page_id):
-    """Fetches a single Confluence page and formats it."""
     try:
-        page = confluence_client.get_page_by_id(page_id, expand='body.storage,version')
-        html_content = page['body']['storage']['value']
-        
-        soup = BeautifulSoup(html_content, 'html.parser')
-        text_content = soup.get_text(separator='\n', strip=True)
-        
-        return {
-            "text": text_content,
-            "metadata": {
-                "doc_id": f"confluence-{page['id']}",
-                "source": "confluence",
-                "title": page['title'],
-                "url": page['_links']['webui'],
-                "created": page['history']['createdDate'],
-                "updated": page['version']['when'],
-                "space": page['space']['key'],
-            }
-        }
+        with metrics.timed("archive"):
+            archive_document(doc)
     except Exception as e:
-        print(f"Failed to fetch Confluence page {page_id}: {e}")
-        return None
+        print(f"Error archiving document {doc_id} to MinIO: {e}")
+    return len(points)
 
-def ingest_confluence():
-    """Ingests data from Confluence using parallel fetching, supporting CQL."""
-    print("Starting Confluence ingestion...")
-    page_ids = []
+def delete_document(doc_id):
+    """Removes all chunks of a document from Qdrant and its raw document from MinIO."""
+    # Chunks other documents share with this one must survive the delete
+    update_operations = release_operations(qdrant_client, COLLECTION_NAME, doc_id)
+    update_operations.append(stale_chunks_operation(doc_id, []))
+    qdrant_client.batch_update_points(
+        collection_name=COLLECTION_NAME,
+        update_operations=update_operations,
+        wait=True
+    )
+    bump_generation(minio_client, MINIO_BUCKET, f"delete {doc_id}")
+    minio_client.remove_object(MINIO_BUCKET, f"{doc_id}.json")
 
-    if CONFLUENCE_CQL:
-        print(f"Fetching pages from Confluence using CQL: {CONFLUENCE_CQL}")
+# A data source: `list_items(source_state, cursors)` yields (query, offset, item_id)
+# tuples, resuming each query at its checkpointed cursor offset. `fetch(item_id)`
+# returns the raw item and `parse(raw)` turns it into a document dictionary.
+# Sources whose listing already returns raw items set `fetch` to None.
+# `fetch_document(doc_id)` returns the raw item of an already ingested document.
+Source = namedtuple("Source", ["name", "list_items", "fetch", "parse", "fetch_document"])
+
+# Progress query of documents re-chunked because a document they share chunks with changed
+DEPENDENTS_QUERY = "__dedup_dependents__"
+
+class IngestionPipeline:
+    """
+    Runs all sources concurrently through fetch -> parse -> chunk -> embed -> upsert
+    stages connected by bounded queues, so network, CPU and GPU work overlap and
+    the run takes about as long as its slowest stage. Raw documents are archived
+    to MinIO by a separate stage that runs in parallel to chunking.
+
+    Documents whose content hash matches the stored one are skipped after parsing.
+    A source's watermark only advances if all of its documents were stored.
+
+    Every listed item carries its (query, offset) position. The state, including
+    a per-source checkpoint with the offset below which every item is done, is
+    saved every CHECKPOINT_INTERVAL_SECONDS. A restarted run resumes listing
+    from the checkpoint, and documents stored before the restart are skipped by
+    their recorded hashes.
+
+    Chunks that are near-duplicates of a chunk already seen in this run are not
+    embedded. The stored chunk lists every document containing it in its
+    `doc_ids` payload, and those documents are recorded in the state as
+    dependents of the chunk's owner. When the owner changes, its dependents are
+    re-chunked along with it so they don't lose the shared content.
+    """
+
+    def __init__(self, sources, state):
+        self.sources = {source.name: source for source in sources}
+        self.state = state
+        self.lock = threading.Lock()
+        self.stats = {source.name: Counter() for source in sources}
+        self.progress = {} # (source, query) -> {"next": offset, "done": set of offsets >= next}
+        self.checkpoints = {source.name: self._start_checkpoint(source.name) for source in sources}
+        # Failures of earlier, interrupted attempts at this run still hold back the watermark
+        self.prior_failures = {name: checkpoint["failed"] for name, checkpoint in self.checkpoints.items()}
+        self.stop_checkpointing = threading.Event()
+        self.dedup_index = NearDuplicateIndex() if DEDUP_ENABLED else None
+        self.chunked = set() # doc_ids chunked in this run
+        self.failed_docs = set() # doc_ids whose chunks were not stored
+        self.requeued = set() # (source, doc_id) re-chunked as dependents
+        self.requeue_offsets = Counter()
+        self.pending_dependents = [tuple(dependent) for dependent in state.get("dedup_requeue", [])]
+        self.writer = QdrantBatchWriter(self._on_batch_done)
+        self.batcher = EmbeddingBatcher(self._on_embedded)
+        self.chunk_stage = Stage("chunk", self._guard("chunk", self._chunk), CHUNK_WORKERS)
+        self.archive_stage = Stage("archive", self._guard("archive", self._archive), ARCHIVE_WORKERS)
+        self.parse_stage = Stage("parse", self._guard("parse", self._parse), PARSE_WORKERS)
+        self.fetch_stage = Stage("fetch", self._guard("fetch", self._fetch), MAX_WORKERS)
+
+    def _source_state(self, source):
+        return self.state["sources"].setdefault(source, {})
+
+    def _start_checkpoint(self, source):
+        checkpoint = self._source_state(source).get("checkpoint")
+        if checkpoint:
+            print(f"Resuming interrupted {source} run started at {checkpoint['run_started']} "
+                  f"from cursors {checkpoint['cursors']}.")
+            return checkpoint
+        return {"run_started": datetime.now(timezone.utc).isoformat(), "failed": 0, "cursors": {}}
+
+    def _count(self, source, key, n=1):
+        with self.lock:
+            self.stats[source][key] += n
+
+    def _complete(self, source, ticket, failed=False):
+        """Marks a listed item as done and advances its query's cursor past all done items."""
+        query, offset = ticket
+        with self.lock:
+            if failed:
+                self.stats[source]["failed"] += 1
+            progress = self.progress[(source, query)]
+            progress["done"].add(offset)
+            while progress["next"] in progress["done"]:
+                progress["done"].remove(progress["next"])
+                progress["next"] += 1
+
+    def _guard(self, stage_name, fn):
+        def guarded(item):
+            source, ticket, payload = item
+            try:
+                fn(source, ticket, payload)
+            except Exception as e:
+                print(f"[{stage_name}] Failed to process {source} item: {e}")
+                self._complete(source, ticket, failed=True)
+        return guarded
+
+    def _enumerate(self, source):
+        print(f"Starting {source.name} ingestion...")
         try:
-            # The atlassian-python-api cql method handles pagination automatically
-            cql_results = confluence_client.cql(CONFLUENCE_CQL, limit=200)
-            # The structure of the result is a dict with a 'results' key
-            page_ids = [page['content']['id'] for page in cql_results.get('results', [])]
+            next_stage = self.fetch_stage if source.fetch else self.parse_stage
+            cursors = self.checkpoints[source.name]["cursors"]
+            for query, offset, item in source.list_items(self._source_state(source.name), cursors):
+                with self.lock:
+                    self.stats[source.name]["listed"] += 1
+                    self.progress.setdefault((source.name, query), {"next": offset, "done": set()})
+                next_stage.put((source.name, (query, offset), item))
         except Exception as e:
-            print(f"Error executing Confluence CQL query: {e}")
-            # Exit gracefully if CQL fails
-            page_ids = []
-    else:
-        print(f"CONFLUENCE_CQL not set. Fetching all pages from spaces: {CONFLUENCE_SPACES}")
-        for space in CONFLUENCE_SPACES:
+            print(f"Error listing {source.name} items: {e}")
+            self._count(source.name, "failed")
+
+    def _fetch(self, source, ticket, item_id):
+        with metrics.timed("fetch"):
+            raw = self.sources[source].fetch(item_id)
+        self.parse_stage.put((source, ticket, raw))
+
+    def _parse(self, source, ticket, raw):
+        with metrics.timed("parse"):
+            doc = self.sources[source].parse(raw)
+            doc_hash = compute_doc_hash(doc)
+        metrics.add_bytes("parse", len(doc['text'].encode('utf-8')))
+        doc_hashes = self._source_state(source).setdefault("doc_hashes", {})
+        if doc_hashes.get(doc['metadata']['doc_id']) == doc_hash:
+            self._count(source, "skipped")
+            self._complete(source, ticket)
+            return
+        self.archive_stage.put((source, ticket, doc))
+        self.chunk_stage.put((source, ticket, (doc, doc_hash)))
+        dependents = self.state.get("dedup_dependents", {}).get(doc['metadata']['doc_id'])
+        if dependents:
+            self._requeue_dependents(dependents)
+
+    def _requeue_dependents(self, dependents):
+        """
+        Fetches documents that share chunks with a changed document and sends
+        them straight to chunking, regardless of their stored hashes. They stay
+        queued in the state until stored, so an interrupted run retries them.
+        """
+        for source, doc_id in dependents:
+            with self.lock:
+                if (source, doc_id) in self.requeued or source not in self.sources:
+                    continue
+                self.requeued.add((source, doc_id))
+                pending = self.state.setdefault("dedup_requeue", [])
+                if [source, doc_id] not in pending:
+                    pending.append([source, doc_id])
+                self.stats[source]["requeued"] += 1
+                self.progress.setdefault((source, DEPENDENTS_QUERY), {"next": 0, "done": set()})
+                offset = self.requeue_offsets[source]
+                self.requeue_offsets[source] += 1
+            ticket = (DEPENDENTS_QUERY, offset)
             try:
-                pages_in_space = confluence_client.get_all_pages_from_space(space)
-                page_ids.extend([page['id'] for page in pages_in_space])
+                with metrics.timed("fetch"):
+                    raw = self.sources[source].fetch_document(doc_id)
+                doc = self.sources[source].parse(raw)
             except Exception as e:
-                print(f"Error fetching pages from space {space}: {e}")
+                print(f"Error fetching dependent document {doc_id}: {e}")
+                self._complete(source, ticket, failed=True)
+                continue
+            self.chunk_stage.put((source, ticket, (doc, compute_doc_hash(doc))))
+
+    def _requeue_pending(self):
+        """Re-chunks the dependents left over from an earlier run."""
+        if self.pending_dependents:
+            print(f"Re-chunking {len(self.pending_dependents)} documents queued by an earlier run.")
+            self._requeue_dependents(self.pending_dependents)
+
+    def _archive(self, source, ticket, doc):
+        # Raw-document archival is best effort and doesn't hold back the watermark
+        try:
+            with metrics.timed("archive"):
+                archived = archive_document(doc)
+            if archived:
+                self._count(source, "archived")
+        except Exception as e:
+            print(f"Error archiving document {doc['metadata']['doc_id']} to MinIO: {e}")
+            self._count(source, "archive_failed")
+
+    def _chunk(self, source, ticket, payload):
+        doc, doc_hash = payload
+        doc_id = doc['metadata']['doc_id']
+
+        with metrics.timed("chunk"):
+            chunks = text_splitter.split_text(doc['text'])
+        metrics.add_bytes("chunk", sum(len(chunk.encode('utf-8')) for chunk in chunks))
+        chunk_indices = list(range(len(chunks)))
+        with self.lock:
+            # A document chunked twice in one run must not match its own earlier chunks
+            first_time = doc_id not in self.chunked
+            self.chunked.add(doc_id)
+        if self.dedup_index is not None and first_time and chunks:
+            with metrics.timed("dedup", items=len(chunks)):
+                chunk_indices = [
+                    i for i, chunk in enumerate(chunks)
+                    if self.dedup_index.find_or_add(chunk, chunk_point_id(doc_id, i), (source, doc_id)) is None
+                ]
+            self._count(source, "duplicate_chunks", len(chunks) - len(chunk_indices))
+            chunks = [chunks[i] for i in chunk_indices]
+        if not chunks:
+            self.writer.add_document((source, ticket), doc_id, doc_hash, [])
+            return
+        self.batcher.add((source, ticket, doc, doc_hash, chunks, chunk_indices), chunks)
+
+    def _on_embedded(self, item, embeddings):
+        source, ticket, doc, doc_hash, chunks, chunk_indices = item
+        doc_id = doc['metadata']['doc_id']
+        if embeddings is None:
+            print(f"Skipping document {doc_id} due to embedding failure.")
+            with self.lock:
+                self.failed_docs.add(doc_id)
+            self._complete(source, ticket, failed=True)
+            return
+        points = build_points(doc, chunks, embeddings, chunk_indices)
+        self.writer.add_document((source, ticket), doc_id, doc_hash, points)
+
+    def _on_batch_done(self, documents, success):
+        for (source, ticket), doc_id, doc_hash in documents:
+            with self.lock:
+                if success:
+                    self._source_state(source).setdefault("doc_hashes", {})[doc_id] = doc_hash
+                    self.stats[source]["stored"] += 1
+                    if ticket[0] == DEPENDENTS_QUERY and [source, doc_id] in self.state.get("dedup_requeue", []):
+                        self.state["dedup_requeue"].remove([source, doc_id])
+                else:
+                    self.failed_docs.add(doc_id)
+            self._complete(source, ticket, failed=not success)
+
+    def _link_shared_chunks(self):
+        """
+        Adds the dependents of every shared chunk to its `doc_ids` payload and
+        records them in the state. Dependents of chunks that weren't stored are
+        counted as failed and queued for re-chunking in the next run.
+        """
+        dependents_state = self.state.setdefault("dedup_dependents", {})
+        for doc_id in self.chunked:
+            dependents_state.pop(doc_id, None)
+        shared = list(self.dedup_index.shared_points())
+        for start in range(0, len(shared), UPSERT_BATCH_SIZE):
+            batch = shared[start:start + UPSERT_BATCH_SIZE]
+            stored = [entry for entry in batch if entry[1][1] not in self.failed_docs]
+            try:
+                if stored:
+                    qdrant_client.batch_update_points(
+                        collection_name=COLLECTION_NAME,
+                        update_operations=[
+                            models.SetPayloadOperation(
+                                set_payload=models.SetPayload(
+                                    payload={"doc_ids": [owner[1]] + [doc_id for _, doc_id in dependents]},
+                                    points=[point_id]
+                                )
+                            )
+                            for point_id, owner, dependents in stored
+                        ],
+                        wait=True
+                    )
+            except Exception as e:
+                print(f"Error linking {len(stored)} shared chunks in Qdrant: {e}")
+                stored = []
+            linked = {entry[0] for entry in stored}
+            with self.lock:
+                for point_id, owner, dependents in batch:
+                    for source, doc_id in dependents:
+                        if point_id in linked:
+                            known = dependents_state.setdefault(owner[1], [])
+                            if [source, doc_id] not in known:
+                                known.append([source, doc_id])
+                            continue
+                        self.stats[source]["failed"] += 1
+                        self._source_state(source).get("doc_hashes", {}).pop(doc_id, None)
+                        pending = self.state.setdefault("dedup_requeue", [])
+                        if [source, doc_id] not in pending:
+                            pending.append([source, doc_id])
+
+    def save_checkpoint(self):
+        """Records each source's cursors and failure count in the state and persists it."""
+        with self.lock:
+            for (source, query), progress in self.progress.items():
+                self.checkpoints[source]["cursors"][query] = progress["next"]
+            for source, checkpoint in self.checkpoints.items():
+                checkpoint["failed"] = self.prior_failures[source] + self.stats[source]["failed"]
+                self._source_state(source)["checkpoint"] = checkpoint
+            state_bytes = serialize_state(self.state)
+        store_state(state_bytes)
+
+    def _checkpoint_loop(self):
+        while not self.stop_checkpointing.wait(CHECKPOINT_INTERVAL_SECONDS):
+            self.save_checkpoint()
 
-    if not page_ids:
-        print("No pages found in Confluence to ingest.")
+    def _sample_queues_loop(self):
+        stages = [self.fetch_stage, self.parse_stage, self.archive_stage, self.chunk_stage]
+        while not self.stop_checkpointing.wait(QUEUE_SAMPLE_SECONDS):
+            for stage in stages:
+                metrics.sample_queue(stage.name, stage.queue.qsize())
+
+    def run(self):
+        """Runs all sources to completion and advances the watermarks of those without failures."""
+        checkpointer = threading.Thread(target=self._checkpoint_loop, name="checkpoint", daemon=True)
+        checkpointer.start()
+        sampler = threading.Thread(target=self._sample_queues_loop, name="queue-sampler", daemon=True)
+        sampler.start()
+        enumerators = [
+            threading.Thread(target=self._enumerate, args=(source,), name=f"list-{source.name}")
+            for source in self.sources.values()
+        ]
+        enumerators.append(threading.Thread(target=self._requeue_pending, name="requeue-dependents"))
+        for thread in enumerators:
+            thread.start()
+        for thread in enumerators:
+            thread.join()
+
+        # Drain the stages in order; each close() waits for the stage's queue to empty
+        self.fetch_stage.close()
+        self.parse_stage.close()
+        self.archive_stage.close()
+        self.chunk_stage.close()
+        self.batcher.close()
+        self.writer.close()
+        if self.dedup_index is not None:
+            self._link_shared_chunks()
+        self.stop_checkpointing.set()
+        checkpointer.join()
+        sampler.join()
+
+        print(f"Uploaded {self.writer.points_uploaded} points to Qdrant.")
+        for name, stats in self.stats.items():
+            self._source_state(name).pop("checkpoint", None)
+            failed = self.prior_failures[name] + stats["failed"]
+            print(f"{name}: {stats['listed']} listed, {stats['skipped']} unchanged, "
+                  f"{stats['stored']} stored, {failed} failed, "
+                  f"{stats['duplicate_chunks']} near-duplicate chunks, "
+                  f"{stats['archived']} archived ({stats['archive_failed']} archive failures).")
+            # Every listed or re-queued item must have ended up stored, unchanged or failed
+            unaccounted = stats["listed"] + stats["requeued"] - stats["stored"] - stats["skipped"] - stats["failed"]
+            if failed == 0 and unaccounted <= 0:
+                self._source_state(name)["watermark"] = self.checkpoints[name]["run_started"]
+            elif unaccounted > 0:
+                print(f"{unaccounted} {name} items were never completed. Keeping the previous watermark.")
+            else:
+                print(f"Some {name} items were not ingested. Keeping the previous watermark.")
+
+def iter_pages(fetch_page, starts, concurrency):
+    """
+    Calls `fetch_page(start)` for every offset in `starts` with up to
+    `concurrency` requests in flight and yields the pages in order.
+    """
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = deque()
+        for start in starts:
+            futures.append(executor.submit(fetch_page, start))
+            if len(futures) >= concurrency:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+def list_paged(query, search_page, get_results, get_total, page_size, concurrency, cursors):
+    """
+    Yields (query, offset, item) for every result of a paged search, fetching up
+    to `concurrency` pages at once. Listing starts one page before the query's
+    checkpointed cursor, since results deleted in the meantime shift offsets down.
+    """
+    cursor = cursors.get(query, 0)
+    start = max(0, cursor - cursor % page_size - page_size)
+    if start:
+        print(f"Resuming at offset {start} for query: {query}")
+    def timed_search_page(page_start):
+        started = time.perf_counter()
+        page = search_page(page_start)
+        metrics.record("fetch", time.perf_counter() - started, items=len(get_results(page)))
+        return page
+
+    first_page = timed_search_page(start)
+    total = get_total(first_page)
+    print(f"Found {total} results for query: {query}")
+    results = get_results(first_page)
+    for offset, item in enumerate(results, start):
+        yield query, offset, item
+    page_size = len(results) or page_size
+    starts = range(start + page_size, total, page_size)
+    for page_start, page in zip(starts, iter_pages(timed_search_page, starts, concurrency)):
+        for offset, item in enumerate(get_results(page), page_start):
+            yield query, offset, item
+
+# Splits a JQL or CQL query from its trailing ORDER BY clause
+ORDER_BY_CLAUSE = re.compile(r'(?:^|\s+)order\s+by\s+', re.IGNORECASE)
+
+def list_jira_issues(source_state, cursors):
+    """
+    Yields the Jira issues to ingest, only those updated since the last run if possible.
+
+    In bulk mode the raw issues are yielded directly from paged search results
+    that include all fields needed for formatting. Otherwise only the issue keys
+    are listed and each issue is fetched separately.
+    """
+    # Results are addressed by offset, so keep the result order stable;
+    # the ORDER BY clause has to stay last when the time filter is added
+    jql, *order = ORDER_BY_CLAUSE.split(JIRA_JQL, maxsplit=1)
+    since = query_since(source_state)
+    if since:
+        updated = f'updated >= "{since.strftime("%Y/%m/%d %H:%M")}"'
+        jql = f'({jql}) AND {updated}' if jql.strip() else updated
+    jql = f"{jql} ORDER BY {order[0] if order else 'key ASC'}"
+    if since:
+        print(f"Incremental Jira ingestion with JQL: {jql}")
+
+    if not JIRA_BULK_FETCH:
+        issues = get_jira_client().search_issues(jql, maxResults=False, fields="key")
+        print(f"Found {len(issues)} issues in Jira.")
+        start = max(0, cursors.get(jql, 0) - JIRA_PAGE_SIZE)
+        for offset, issue in enumerate(issues[start:], start):
+            yield jql, offset, issue.key
         return
 
-    print(f"Found {len(page_ids)} pages to process.")
+    def search_page(start):
+        return get_jira_client().search_issues(jql, startAt=start, maxResults=JIRA_PAGE_SIZE, fields=JIRA_FIELDS)
+
+    yield from list_paged(jql, search_page, list, lambda page: page.total, JIRA_PAGE_SIZE, JIRA_PAGE_CONCURRENCY, cursors)
+
+JIRA_ISSUE_KEY = re.compile(r'[A-Z][A-Z0-9_]*-[0-9]+', re.IGNORECASE)
 
-    documents = []
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        future_to_page = {executor.submit(fetch_confluence_page, page_id): page_id for page_id in page_ids}
-        for future in as_completed(future_to_page):
-            result = future.result()
-            if result:
-                documents.append(result)
+def jira_issue_in_scope(issue_key):
+    """Returns whether JIRA_JQL selects the issue, i.e. whether a batch run would ingest it."""
+    if not JIRA_ISSUE_KEY.fullmatch(issue_key): # The key is inserted into the JQL below
+        return False
+    jql, *_ = ORDER_BY_CLAUSE.split(JIRA_JQL, maxsplit=1)
+    scope = f"({jql}) AND key = {issue_key}" if jql.strip() else f"key = {issue_key}"
+    return len(get_jira_client().search_issues(scope, maxResults=1, fields="key")) > 0
 
-    if not documents:
-        print("Failed to fetch details for any of the found page IDs.")
+def get_jira_issue(issue_key):
+    """Fetches a single raw Jira issue."""
+    return get_jira_client().issue(issue_key, fields=JIRA_FIELDS)
+
+def format_jira_issue(issue):
+    """Formats a raw Jira issue as a document dictionary."""
+    content = [issue.fields.summary, issue.fields.description or ""]
+    for comment in issue.fields.comment.comments:
+        content.append(comment.body)
+    
+    text_content = "\n\n".join(filter(None, content))
+    
+    return {
+        "text": text_content,
+        "metadata": {
+            "doc_id": f"jira-{issue.key}",
+            "source": "jira",
+            "title": issue.fields.summary,
+            "url": issue.permalink(),
+            "created": issue.fields.created,
+            "updated": issue.fields.updated,
+            "project": issue.fields.project.key,
+            "status": issue.fields.status.name,
+        }
+    }
+
+def fetch_jira_issue(issue_key):
+    """Fetches a single Jira issue and formats it."""
+    try:
+        return format_jira_issue(get_jira_issue(issue_key))
+    except Exception as e:
+        print(f"Failed to fetch Jira issue {issue_key}: {e}")
+        return None
+
+
+def confluence_queries(since):
+    """Returns the CQL queries to ingest, one per space unless CONFLUENCE_CQL is set."""
+    if CONFLUENCE_CQL:
+        queries = [CONFLUENCE_CQL]
+    else:
+        print(f"CONFLUENCE_CQL not set. Fetching all pages from spaces: {CONFLUENCE_SPACES}")
+        queries = [f'space = "{space.strip()}" AND type = page' for space in CONFLUENCE_SPACES]
+    ordered = []
+    for cql in queries:
+        # Results are addressed by offset, so keep the result order stable;
+        # the ORDER BY clause has to stay last when the time filter is added
+        cql, *order = ORDER_BY_CLAUSE.split(cql, maxsplit=1)
+        ordered.append((cql, order[0] if order else "created asc"))
+    if since:
+        ordered = [(f'({cql}) AND lastmodified >= "{since.strftime("%Y/%m/%d %H:%M")}"', order) for cql, order in ordered]
+    return [f"{cql} order by {order}" for cql, order in ordered]
+
+def list_confluence_pages(source_state, cursors):
+    """
+    Yields the raw Confluence pages to ingest, supporting CQL, spaces and incremental runs.
+
+    Page bodies and all metadata needed for formatting are expanded in the
+    search calls themselves, and result pages are fetched concurrently, so no
+    per-page requests are needed.
+    """
+    for cql in confluence_queries(query_since(source_state)):
+        print(f"Fetching pages from Confluence using CQL: {cql}")
+
+        def search_page(start):
+            return confluence_client.cql(cql, start=start, limit=CONFLUENCE_PAGE_SIZE, expand=CONFLUENCE_SEARCH_EXPAND)
+
+        # The structure of the result is a dict with a 'results' key
+        def get_pages(search_result):
+            return [result['content'] for result in search_result.get('results', [])]
+
+        yield from list_paged(
+            cql, search_page, get_pages, lambda search_result: search_result.get('totalSize', 0),
+            CONFLUENCE_PAGE_SIZE, CONFLUENCE_PAGE_CONCURRENCY, cursors
+        )
+
+def get_confluence_page(page_id):
+    """Fetches a single raw Confluence page."""
+    return confluence_client.get_page_by_id(page_id, expand=CONFLUENCE_PAGE_EXPAND)
+
+CDATA_PATTERN = re.compile(r'<!\[CDATA\[(.*?)\]\]>', re.DOTALL)
+
+def html_to_text(html_content, parser=HTML_PARSER):
+    """
+    Extracts the text of an HTML fragment, one stripped string per line.
+
+    Confluence storage format keeps code macro bodies in CDATA sections, which
+    HTML parsers other than html.parser drop. They are escaped into plain text
+    first, so every parser backend returns the same text.
+    """
+    html_content = CDATA_PATTERN.sub(lambda match: html.escape(match.group(1)), html_content)
+    soup = BeautifulSoup(html_content, parser)
+    return soup.get_text(separator='\n', strip=True)
+
+html_parse_pool = None # Created by start_html_parse_pool; pages are parsed inline without it
+
+def start_html_parse_pool():
+    """
+    Creates the HTML parse process pool and starts all of its workers. Must run
+    before any other thread starts: the workers are forked, since spawned ones
+    would re-import this module and rebuild all of its clients, and forking a process
+    with running threads can copy their held locks into the children.
+    """
+    global html_parse_pool
+    if PARSE_PROCESSES <= 0:
         return
-        
-    print(f"Successfully fetched {len(documents)} pages. Processing and uploading...")
-    process_and_upload_documents(documents)
-    print("Confluence ingestion finished.")
+    html_parse_pool = ProcessPoolExecutor(max_workers=PARSE_PROCESSES, mp_context=multiprocessing.get_context("fork"))
+    # Workers are started on demand; keep them all busy at once so every fork happens now
+    for future in [html_parse_pool.submit(time.sleep, 0.1) for _ in range(PARSE_PROCESSES)]:
+        future.result()
+
+def extract_html_text(html_content):
+    """Runs html_to_text in the parse process pool, or inline for small pages."""
+    if html_parse_pool is None or len(html_content) < HTML_PROCESS_MIN_BYTES:
+        return html_to_text(html_content)
+    return html_parse_pool.submit(html_to_text, html_content).result()
+
+def format_confluence_page(page):
+    """Extracts the text of a raw Confluence page and formats it as a document dictionary."""
+    text_content = extract_html_text(page['body']['storage']['value'])
+
+    return {
+        "text": text_content,
+        "metadata": {
+            "doc_id": f"confluence-{page['id']}",
+            "source": "confluence",
+            "title": page['title'],
+            "url": page['_links']['webui'],
+            "created": page['history']['createdDate'],
+            "updated": page['version']['when'],
+            "space": page['space']['key'],
+        }
+    }
+
+def fetch_confluence_page(page_id):
+    """Fetches a single Confluence page and formats it."""
+    try:
+        return format_confluence_page(get_confluence_page(page_id))
+    except Exception as e:
+        print(f"Failed to fetch Confluence page {page_id}: {e}")
+        return None
+
+JIRA_SOURCE = Source(
+    "jira", list_jira_issues, None if JIRA_BULK_FETCH else get_jira_issue, format_jira_issue,
+    lambda doc_id: get_jira_issue(doc_id[len("jira-"):])
+)
+CONFLUENCE_SOURCE = Source(
+    "confluence", list_confluence_pages, None, format_confluence_page,
+    lambda doc_id: get_confluence_page(doc_id[len("confluence-"):])
+)
 
 
 def main():
     """Main function to run the ingestion job."""
     print("Starting ingestion job...")
+    start_html_parse_pool()
     
     # 1. Ensure Qdrant collection exists
     try:
@@ -269,6 +1570,14 @@ def main():
             vectors_config=models.VectorParams(size=1024, distance=models.Distance.COSINE), # Adjust size based on embedding model
         )
 
+    # Stale-chunk pruning filters on doc_id and deletes on doc_ids, so keep both indexed (no-op if the index exists)
+    for field_name in ["metadata.doc_id", "doc_ids"]:
+        qdrant_client.create_payload_index(
+            collection_name=COLLECTION_NAME,
+            field_name=field_name,
+            field_schema=models.PayloadSchemaType.KEYWORD,
+        )
+
     # 2. Ensure MinIO bucket exists
     if not minio_client.bucket_exists(MINIO_BUCKET):
         print(f"Creating MinIO bucket '{MINIO_BUCKET}'...")
@@ -276,11 +1585,33 @@ def main():
     else:
         print(f"MinIO bucket '{MINIO_BUCKET}' already exists.")
 
-    # 3. Run ingestion sources
-    ingest_jira()
-    ingest_confluence()
+    # 3. Run all ingestion sources concurrently and persist the state
+    state = load_state()
+    hash_updates = merge_doc_hash_updates(state)
+    pipeline = IngestionPipeline([JIRA_SOURCE, CONFLUENCE_SOURCE], state)
+    pipeline.run()
+    if save_state(state):
+        remove_doc_hash_updates(hash_updates)
+    # Cached query results may point at replaced chunks now
+    if any(stats["stored"] for stats in pipeline.stats.values()):
+        bump_generation(minio_client, MINIO_BUCKET, "ingestion run")
+    if html_parse_pool is not None:
+        html_parse_pool.shutdown()
+
+    # 4. Report the run summary
+    summary = metrics.summary()
+    summary["sources"] = {name: dict(stats) for name, stats in pipeline.stats.items()}
+    stored = sum(stats["stored"] for stats in pipeline.stats.values())
+    embedded = summary["stages"].get("embed", {}).get("items", 0)
+    summary["documents_per_second"] = round(stored / summary["duration_seconds"], 2)
+    summary["chunks_per_second"] = round(embedded / summary["duration_seconds"], 2)
+    summary["embedding_service"] = embedding_client.stats()
+    summary["http_retries"] = summary["embedding_service"]["retries"]
+    summary["embedding_cache"] = embedding_cache.stats() if embedding_cache is not None else None
+    print(f"Run summary: {json.dumps(summary)}")
+    push_metrics(summary)
 
     print("Ingestion job finished.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,232 @@
+from fastapi import FastAPI, HTTPException, Request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import hmac
+import os
+import threading
+import time
+
+from ingest_data import (
+    CONFLUENCE_CQL,
+    CONFLUENCE_SPACES,
+    compute_doc_hash,
+    delete_document,
+    fetch_confluence_page,
+    fetch_jira_issue,
+    ingest_document,
+    jira_issue_in_scope,
+    load_state,
+    record_doc_hash,
+)
+
+# --- Configuration ---
+# A document is re-ingested this long after its last event...
+WEBHOOK_DEBOUNCE_SECONDS = float(os.getenv("WEBHOOK_DEBOUNCE_SECONDS", 2))
+# ...but never later than this after its first one, even if events keep coming
+WEBHOOK_MAX_DELAY_SECONDS = float(os.getenv("WEBHOOK_MAX_DELAY_SECONDS", 10))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 4))
+# Optional shared secret, passed as the `secret` query parameter or the X-Webhook-Secret header
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# How long the near-duplicate dependents loaded from the ingestion state are reused
+DEPENDENTS_REFRESH_SECONDS = float(os.getenv("DEPENDENTS_REFRESH_SECONDS", 60))
+
+INGESTED_SPACES = {space.strip() for space in CONFLUENCE_SPACES if space.strip()}
+
+JIRA_DELETE_EVENTS = {"jira:issue_deleted"}
+CONFLUENCE_DELETE_EVENTS = {"page_removed", "page_trashed"}
+
+# Fetches and formats a document by its source item ID, or returns None on failure.
+# Document IDs are "<source>-<item ID>".
+FETCHERS = {
+    "jira": fetch_jira_issue,
+    "confluence": fetch_confluence_page,
+}
+
+app = FastAPI()
+
+class Debouncer:
+    """
+    Coalesces events per key. A key is processed `delay` seconds after its
+    last event, but no later than `max_delay` seconds after its first, so a
+    burst of edits to one document triggers a single `process(key, action)`
+    call. The latest action wins. Events for a key that is being processed
+    are queued and processed once it finishes.
+    """
+
+    def __init__(self, process, delay=WEBHOOK_DEBOUNCE_SECONDS, max_delay=WEBHOOK_MAX_DELAY_SECONDS, workers=WEBHOOK_WORKERS):
+        self.process = process
+        self.delay = delay
+        self.max_delay = max_delay
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.condition = threading.Condition()
+        self.pending = {} # key -> {"first": time, "last": time, "action": action}
+        self.running = set()
+        self.stats = Counter()
+        threading.Thread(target=self._dispatch_loop, name="debouncer", daemon=True).start()
+
+    def submit(self, key, action):
+        now = time.monotonic()
+        with self.condition:
+            self.stats["events"] += 1
+            entry = self.pending.get(key)
+            if entry:
+                self.stats["coalesced"] += 1
+                entry["last"] = now
+                entry["action"] = action
+            else:
+                self.pending[key] = {"first": now, "last": now, "action": action}
+            self.condition.notify()
+
+    def _due_at(self, entry):
+        return min(entry["last"] + self.delay, entry["first"] + self.max_delay)
+
+    def _dispatch_loop(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                timeout = None
+                for key, entry in list(self.pending.items()):
+                    if key in self.running:
+                        continue
+                    due_at = self._due_at(entry)
+                    if due_at <= now:
+                        del self.pending[key]
+                        self.running.add(key)
+                        self.executor.submit(self._run, key, entry)
+                    elif timeout is None or due_at - now < timeout:
+                        timeout = due_at - now
+                self.condition.wait(timeout)
+
+    def _run(self, key, entry):
+        try:
+            self.process(key, entry["action"])
+            self._count("processed", lag=time.monotonic() - entry["first"])
+        except Exception as e:
+            print(f"Failed to process {entry['action']} of {key}: {e}")
+            self._count("failed")
+        finally:
+            with self.condition:
+                self.running.discard(key)
+                self.condition.notify()
+
+    def _count(self, key, lag=None):
+        with self.condition:
+            self.stats[key] += 1
+            if lag is not None:
+                self.stats["lag_total_seconds"] += lag
+                self.stats["lag_max_seconds"] = max(self.stats["lag_max_seconds"], lag)
+
+    def summary(self):
+        with self.condition:
+            stats = dict(self.stats)
+            processed = stats.get("processed", 0)
+            stats["lag_mean_seconds"] = round(stats.pop("lag_total_seconds", 0) / processed, 3) if processed else 0
+            stats["pending"] = len(self.pending)
+            stats["running"] = len(self.running)
+            return stats
+
+class DependentsCache:
+    """
+    The "dedup_dependents" map of the ingestion state, reloaded from MinIO at
+    most every `refresh_seconds` instead of on every processed event.
+    """
+
+    def __init__(self, refresh_seconds=DEPENDENTS_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self.lock = threading.Lock()
+        self.dependents = {}
+        self.loaded_at = None
+
+    def get(self, doc_id):
+        with self.lock:
+            now = time.monotonic()
+            if self.loaded_at is None or now - self.loaded_at >= self.refresh_seconds:
+                self.dependents = load_state().get("dedup_dependents", {})
+                self.loaded_at = now
+            return self.dependents.get(doc_id, [])
+
+dependents_cache = DependentsCache()
+
+def record_hash(source, doc_id, doc_hash):
+    """Records the document's new hash for the next batch run; at worst that run ingests it again."""
+    try:
+        record_doc_hash(source, doc_id, doc_hash)
+    except Exception as e:
+        print(f"Error recording the hash of {doc_id}: {e}")
+
+def process_document(key, action):
+    """Re-ingests or deletes one document, then re-ingests the documents sharing its chunks."""
+    source, item_id = key
+    doc_id = f"{source}-{item_id}"
+    if action == "delete":
+        delete_document(doc_id)
+        record_hash(source, doc_id, None)
+        print(f"Deleted document {doc_id}.")
+    else:
+        # Jira webhooks can't filter by JQL, so apply the batch job's scope here
+        if source == "jira" and not jira_issue_in_scope(item_id):
+            print(f"Ignored {doc_id}, JIRA_JQL does not select it.")
+            return
+        doc = FETCHERS[source](item_id)
+        if doc is None:
+            raise RuntimeError(f"Could not fetch {doc_id}")
+        points = ingest_document(doc)
+        # The next batch run skips the document unless it changes again
+        record_hash(source, doc_id, compute_doc_hash(doc))
+        print(f"Re-ingested document {doc_id} ({points} chunks).")
+
+    # Chunks of other documents may have been stored as near-duplicates of this
+    # document's chunks by the last batch run, so they are re-ingested in full.
+    for dependent_source, dependent_id in dependents_cache.get(doc_id):
+        prefix = f"{dependent_source}-"
+        if dependent_source in FETCHERS and dependent_id.startswith(prefix):
+            debouncer.submit((dependent_source, dependent_id[len(prefix):]), "upsert")
+
+debouncer = Debouncer(process_document)
+
+def check_secret(request):
+    if not WEBHOOK_SECRET:
+        return
+    provided = request.query_params.get("secret") or request.headers.get("X-Webhook-Secret") or ""
+    if not hmac.compare_digest(provided.encode('utf-8'), WEBHOOK_SECRET.encode('utf-8')):
+        raise HTTPException(status_code=401, detail="Invalid webhook secret")
+
+@app.post("/webhook/jira")
+async def jira_webhook(request: Request):
+    """Handles Jira issue and comment events."""
+    check_secret(request)
+    payload = await request.json()
+    event = payload.get("webhookEvent", "")
+    issue_key = (payload.get("issue") or {}).get("key")
+    if not issue_key:
+        return {"status": "ignored", "reason": "no issue in payload"}
+    action = "delete" if event in JIRA_DELETE_EVENTS else "upsert"
+    debouncer.submit(("jira", issue_key), action)
+    return {"status": "queued", "doc_id": f"jira-{issue_key}", "action": action}
+
+@app.post("/webhook/confluence")
+async def confluence_webhook(request: Request):
+    """Handles Confluence page events."""
+    check_secret(request)
+    payload = await request.json()
+    event = payload.get("webhookEvent") or payload.get("eventType") or payload.get("event") or ""
+    page = payload.get("page") or {}
+    page_id = page.get("id")
+    if not page_id:
+        return {"status": "ignored", "reason": "no page in payload"}
+    # Only follow the configured spaces, unless a custom CQL query defines the scope
+    space_key = page.get("spaceKey") or (page.get("space") or {}).get("key")
+    if space_key and not CONFLUENCE_CQL and space_key.strip() not in INGESTED_SPACES:
+        return {"status": "ignored", "reason": f"space {space_key} is not ingested"}
+    action = "delete" if event in CONFLUENCE_DELETE_EVENTS else "upsert"
+    debouncer.submit(("confluence", str(page_id)), action)
+    return {"status": "queued", "doc_id": f"confluence-{page_id}", "action": action}
+
+@app.get("/stats")
+def stats():
+    """Returns event, coalescing and processing statistics."""
+    return debouncer.summary()
+
+@app.get("/health")
+def health():
+    return {"status": "ok"}
@@ -0,0 +1,77 @@
+"""
+Checks the configured BACKEND against the PyTorch model and benchmarks both on CPU.
+
+    BACKEND=onnx-int8 python check_backend.py [--pairs FILE] [--count N]
+
+Parity is the largest absolute score difference between both models for the
+same (query, doc) pairs and whether each query ranks its docs the same.
+Exits with status 1 if the difference exceeds --max-score-diff or a ranking differs.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from sentence_transformers import CrossEncoder
+
+import reranker_app
+
+SAMPLE_QUERY = "如何配置 Kubernetes 的水平自动伸缩？"
+SAMPLE_DOCS = [
+    "HPA 根据 CPU 使用率自动调整 Deployment 的副本数。",
+    "首先需要安装 Metrics Server，然后为 Deployment 设置 CPU 请求值。",
+    "The ingestion job failed because the embedding service returned 503.",
+    "Confluence 页面中的代码宏保存在 CDATA 段里。",
+    "这是另一个无关的文档。",
+    "kubectl autoscale deployment web --cpu-percent=50 --min=1 --max=10",
+]
+DOCS_PER_QUERY = len(SAMPLE_DOCS)
+
+def benchmark(model, pairs, batch_size):
+    """Returns (scores, pairs per second) of scoring `pairs` once after a warm-up."""
+    model.predict(pairs[:batch_size], batch_size=batch_size)
+    started = time.perf_counter()
+    scores = model.predict(pairs, batch_size=batch_size)
+    return np.asarray(scores), len(pairs) / (time.perf_counter() - started)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pairs", help=f"File with one tab-separated query and doc per line, "
+                                        f"in groups of {DOCS_PER_QUERY} per query (default: built-in samples)")
+    parser.add_argument("--count", type=int, default=DOCS_PER_QUERY * 40, help="Number of pairs to score")
+    parser.add_argument("--batch-size", type=int, default=reranker_app.BATCH_SIZE)
+    parser.add_argument("--max-score-diff", type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.pairs:
+        with open(args.pairs, encoding="utf-8") as f:
+            pairs = [tuple(line.rstrip("\n").split("\t", 1)) for line in f if "\t" in line]
+    else:
+        pairs = [(SAMPLE_QUERY, doc) for doc in SAMPLE_DOCS]
+    count = max(DOCS_PER_QUERY, args.count - args.count % DOCS_PER_QUERY)
+    pairs = (pairs * (count // len(pairs) + 1))[:count]
+    cores = len(os.sched_getaffinity(0))
+
+    reference = CrossEncoder(reranker_app.model_name, device="cpu")
+    reference_scores, reference_rate = benchmark(reference, pairs, args.batch_size)
+    scores, rate = benchmark(reranker_app.model, pairs, args.batch_size)
+
+    max_diff = np.abs(reference_scores - scores).max()
+    same_ranking = all(
+        np.array_equal(np.argsort(-reference_scores[start:start + DOCS_PER_QUERY]),
+                       np.argsort(-scores[start:start + DOCS_PER_QUERY]))
+        for start in range(0, len(pairs), DOCS_PER_QUERY)
+    )
+    print(f"Model: {reranker_app.model_name}, {len(pairs)} pairs, {cores} cores")
+    print(f"torch (cpu): {reference_rate:.1f} pairs/s, {reference_rate / cores:.2f} pairs/s per core")
+    print(f"{reranker_app.BACKEND}: {rate:.1f} pairs/s, {rate / cores:.2f} pairs/s per core "
+          f"({rate / reference_rate:.2f}x)")
+    print(f"Max score difference to torch: {max_diff:.5f}, same ranking: {same_ranking}")
+    if max_diff > args.max_score_diff or not same_ranking:
+        print("Parity check failed.")
+        sys.exit(1)
+    print("Parity check passed.")
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,197 @@
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from sentence_transformers import CrossEncoder
+from collections import Counter, OrderedDict
+from typing import Optional
+import asyncio
+import hashlib
 import os
+import threading
+import time
+import unicodedata
+
+import numpy as np
+
+from common.batching import MicroBatcher, PaddingStats, length_sorted_batches
+from common.model_loading import BACKEND, load_model
 
 app = FastAPI()
 
 class RerankRequest(BaseModel):
     query: str
     docs: list[str]
+    top_k: Optional[int] = Field(None, ge=1) # Only return the k best docs
+    max_doc_tokens: Optional[int] = Field(None, ge=1) # Truncate docs to this many tokens before scoring
 
 # Load the model from the environment variable
 model_name = os.getenv("RERANKER_MODEL_NAME", "BAAI/bge-reranker-base")
-model = CrossEncoder(model_name)
+model = load_model(CrossEncoder, model_name)
+
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", 32)) # (query, doc) pairs per forward pass
+# Concurrent requests are coalesced into one predict call of up to MAX_BATCH_PAIRS
+# pairs, waiting at most MAX_WAIT_MS for more requests after the first one.
+MAX_BATCH_PAIRS = int(os.getenv("MAX_BATCH_PAIRS", 128))
+MAX_WAIT_MS = float(os.getenv("MAX_WAIT_MS", 5))
+MAX_DOC_TOKENS = int(os.getenv("MAX_DOC_TOKENS", 0)) # Default for requests without max_doc_tokens; 0 disables
+
+# Scores of (query, doc) pairs are cached by normalized query and doc content hash; 0 entries disables the cache
+SCORE_CACHE_MAX_ENTRIES = int(os.getenv("SCORE_CACHE_MAX_ENTRIES", 100000))
+SCORE_CACHE_TTL_SECONDS = float(os.getenv("SCORE_CACHE_TTL_SECONDS", 3600))
+
+padding_stats = PaddingStats()
+
+def predict(pairs, batch_size=BATCH_SIZE):
+    """
+    Scores (query, doc) pairs in sub-batches of similar token length, so short
+    pairs aren't padded to the longest pair of a batch, and returns the scores in order.
+    """
+    tokenized = model.tokenizer(
+        [query for query, _ in pairs], [doc for _, doc in pairs],
+        truncation=True, max_length=model.max_length
+    )
+    lengths = [len(input_ids) for input_ids in tokenized["input_ids"]]
+    batches = length_sorted_batches(lengths, batch_size)
+    # CrossEncoder.predict batches the pairs in the order it gets them
+    arrival_order = [range(start, min(start + batch_size, len(pairs))) for start in range(0, len(pairs), batch_size)]
+    padding_stats.record(lengths, batches, arrival_order)
+
+    scores = np.concatenate([
+        model.predict([pairs[i] for i in batch], batch_size=len(batch))
+        for batch in batches
+    ])
+    # Undo the length sort
+    order = np.concatenate([np.asarray(batch) for batch in batches])
+    restored = np.empty_like(scores)
+    restored[order] = scores
+    return restored
+
+batcher = MicroBatcher(lambda pairs, _: predict(pairs), MAX_BATCH_PAIRS, MAX_WAIT_MS, item_name="pairs")
+
+class ScoreCache:
+    """
+    LRU cache of pair scores with a time-to-live, holding at most `max_entries`.
+    Keys include the sha256 of the scored doc text, so a chunk whose content
+    changed never hits a stale score. Thread-safe.
+    """
+
+    def __init__(self, max_entries, ttl_seconds, model_id):
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self.model_id = model_id
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # key -> (score, expires_at)
+        self.stats = Counter()
+
+    def key(self, query, doc):
+        return (self.model_id, query, hashlib.sha256(doc.encode('utf-8')).digest())
+
+    def get_many(self, keys):
+        """Returns the cached score of each key, or None."""
+        now = time.monotonic()
+        scores = []
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is not None and entry[1] <= now:
+                    del self.entries[key]
+                    self.stats["expired"] += 1
+                    entry = None
+                if entry is None:
+                    self.stats["misses"] += 1
+                    scores.append(None)
+                    continue
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                scores.append(entry[0])
+        return scores
+
+    def put_many(self, entries):
+        expires_at = time.monotonic() + self.ttl
+        with self.lock:
+            for key, score in entries.items():
+                self.entries[key] = (score, expires_at)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def summary(self):
+        with self.lock:
+            stats = dict(self.stats)
+            lookups = stats.get("hits", 0) + stats.get("misses", 0)
+            stats["hit_rate"] = round(stats.get("hits", 0) / lookups, 4) if lookups else 0
+            stats["entries"] = len(self.entries)
+            return stats
+
+score_cache = ScoreCache(SCORE_CACHE_MAX_ENTRIES, SCORE_CACHE_TTL_SECONDS, f"{model_name}:{BACKEND}") if SCORE_CACHE_MAX_ENTRIES > 0 else None
+
+def normalize_query(query):
+    """Normalizes Unicode and whitespace, so trivially different spellings share cached scores."""
+    return " ".join(unicodedata.normalize("NFC", query).split())
+
+async def score(query, docs):
+    """Returns the scores of `docs` for `query` in order, only scoring pairs missing from the cache."""
+    if score_cache is None:
+        return await batcher.submit([(query, doc) for doc in docs])
+    keys = [score_cache.key(query, doc) for doc in docs]
+    scores = score_cache.get_many(keys)
+    missing = {} # key -> doc, each distinct doc is scored once
+    for key, doc, cached in zip(keys, docs, scores):
+        if cached is None:
+            missing.setdefault(key, doc)
+    if missing:
+        fresh = dict(zip(missing.keys(), (await batcher.submit([(query, doc) for doc in missing.values()])).tolist()))
+        score_cache.put_many(fresh)
+        scores = [fresh[key] if cached is None else cached for key, cached in zip(keys, scores)]
+    return np.asarray(scores, dtype=np.float32)
+
+def truncate_docs(docs, max_tokens):
+    """Cuts each doc after its first `max_tokens` tokens, keeping the original text up to that point."""
+    if not model.tokenizer.is_fast: # Character offsets need a fast tokenizer
+        return docs
+    tokenized = model.tokenizer(docs, add_special_tokens=False, return_offsets_mapping=True)
+    return [
+        doc[:offsets[max_tokens - 1][1]] if len(offsets) > max_tokens else doc
+        for doc, offsets in zip(docs, tokenized["offset_mapping"])
+    ]
+
+@app.on_event("startup")
+async def start_batcher():
+    batcher.start()
 
 @app.post("/rerank")
-def rerank(request: RerankRequest):
+async def rerank(request: RerankRequest):
     try:
-        scores = model.predict([(request.query, doc) for doc in request.docs])
-        return {"scores": scores.tolist(), "model_used": model_name}
+        docs = request.docs
+        max_doc_tokens = request.max_doc_tokens or MAX_DOC_TOKENS
+        if docs and max_doc_tokens > 0:
+            docs = await asyncio.get_running_loop().run_in_executor(None, truncate_docs, docs, max_doc_tokens)
+        scores = await score(normalize_query(request.query), docs) if docs else np.zeros(0)
+
+        # Best first; stable, so equal scores keep their input order
+        ranking = np.argsort(-scores, kind="stable")
+        if request.top_k is not None:
+            ranking = ranking[:request.top_k]
+        response = {
+            "results": [{"index": int(i), "score": float(scores[i])} for i in ranking],
+            "model_used": model_name,
+        }
+        if request.top_k is None:
+            response["scores"] = scores.tolist() # Input order, for clients that sort themselves
+        return response
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/stats")
+def stats():
+    """Returns micro-batching, padding and score cache statistics."""
+    return {
+        "backend": BACKEND,
+        "batching": batcher.summary(),
+        "padding": padding_stats.summary(),
+        "cache": score_cache.summary() if score_cache is not None else None,
+    }
+
 @app.get("/health")
 def health():
     return {"status": "ok"}
@@ -1,9 +1,22 @@
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
-import requests
-from qdrant_client import QdrantClient, models
+from qdrant_client import AsyncQdrantClient, QdrantClient, models
 from minio import Minio
+from collections import Counter, OrderedDict
+import asyncio
+import hashlib
+import json
 import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+import httpx
+
+from common.collection_generation import bump_generation, read_generation
+from common.http_client import AsyncServiceClient
+from common.shared_chunks import release_operations
 
 app = FastAPI()
 
@@ -12,9 +25,29 @@ class QueryRequest(BaseModel):
 
 # --- Configuration ---
 QDRANT_ENDPOINT = os.getenv("QDRANT_ENDPOINT")
-EMBEDDING_SERVICE_URL = "http://embedding-service:8000/embed"
-RERANKER_SERVICE_URL = "http://reranker-service:8000/rerank"
+EMBEDDING_SERVICE_URL = os.getenv("EMBEDDING_SERVICE_URL", "http://embedding-service:8000/embed")
+RERANKER_SERVICE_URL = os.getenv("RERANKER_SERVICE_URL", "http://reranker-service:8000/rerank")
 COLLECTION_NAME = "knowledge_base"
+SEARCH_LIMIT = int(os.getenv("SEARCH_LIMIT", 10)) # Candidates retrieved from Qdrant
+RERANK_TOP_K = int(os.getenv("RERANK_TOP_K", 10)) # Results returned per query
+RERANK_MAX_DOC_TOKENS = int(os.getenv("RERANK_MAX_DOC_TOKENS", 0)) # 0 uses the reranker's default
+# Optional cascade: a reranker service running a small cross-encoder scores all
+# candidates first, and only its FIRST_STAGE_TOP_N best go to the main reranker.
+FIRST_STAGE_RERANKER_URL = os.getenv("FIRST_STAGE_RERANKER_URL")
+FIRST_STAGE_TOP_N = int(os.getenv("FIRST_STAGE_TOP_N", 20))
+
+# Concurrency: queries beyond MAX_CONCURRENT_QUERIES wait for a slot, and every
+# query fails with 504 after QUERY_TIMEOUT_SECONDS including the wait.
+MAX_CONCURRENT_QUERIES = int(os.getenv("MAX_CONCURRENT_QUERIES", 512))
+QUERY_TIMEOUT_SECONDS = float(os.getenv("QUERY_TIMEOUT_SECONDS", 30))
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", 64)) # Per upstream service
+QDRANT_TIMEOUT = int(os.getenv("QDRANT_TIMEOUT", 10)) # Seconds
+
+# Query result cache
+QUERY_CACHE_MAX_MB = int(os.getenv("QUERY_CACHE_MAX_MB", 64)) # 0 disables the cache
+QUERY_CACHE_TTL_SECONDS = float(os.getenv("QUERY_CACHE_TTL_SECONDS", 300))
+QUERY_CACHE_PATH = os.getenv("QUERY_CACHE_PATH", "") # Optional SQLite file shared by all workers on the node
+GENERATION_CHECK_SECONDS = float(os.getenv("GENERATION_CHECK_SECONDS", 5))
 
 # MinIO Configuration
 MINIO_ENDPOINT = os.getenv("MINIO_ENDPOINT")
@@ -23,50 +56,300 @@ MINIO_SECRET_KEY = os.getenv("MINIO_SECRET_KEY")
 MINIO_BUCKET = "raw-data"
 
 # --- Clients ---
-qdrant_client = QdrantClient(host=QDRANT_ENDPOINT, port=6333)
+qdrant_client = AsyncQdrantClient(
+    host=QDRANT_ENDPOINT, port=6333, timeout=QDRANT_TIMEOUT,
+    limits=httpx.Limits(max_connections=UPSTREAM_MAX_CONNECTIONS, max_keepalive_connections=UPSTREAM_MAX_CONNECTIONS)
+)
+# The shared-chunk lookups of deletes are synchronous and run in worker threads
+qdrant_sync_client = QdrantClient(host=QDRANT_ENDPOINT, port=6333, timeout=QDRANT_TIMEOUT)
 minio_client = Minio(MINIO_ENDPOINT, access_key=MINIO_ACCESS_KEY, secret_key=MINIO_SECRET_KEY, secure=False)
+embedding_client = AsyncServiceClient(EMBEDDING_SERVICE_URL, max_concurrency=UPSTREAM_MAX_CONNECTIONS)
+reranker_client = AsyncServiceClient(RERANKER_SERVICE_URL, max_concurrency=UPSTREAM_MAX_CONNECTIONS)
+first_stage_client = AsyncServiceClient(FIRST_STAGE_RERANKER_URL, max_concurrency=UPSTREAM_MAX_CONNECTIONS) if FIRST_STAGE_RERANKER_URL else None
+query_slots = None # Created on startup, inside the server's event loop
+
+class QueryCache:
+    """
+    Caches query responses by normalized request, with a time-to-live and a
+    memory bound on the serialized responses (least recently used first out).
+
+    Entries belong to a collection generation. When the generation changes
+    the cache is cleared, and responses computed under an older generation
+    are not stored. Entries listing a deleted document can be dropped right
+    away with `invalidate_document`.
+
+    With a `shared_path`, entries are also kept in a SQLite file that other
+    workers and pods on the same node read and write. Thread-safe.
+    """
+
+    def __init__(self, max_bytes, ttl_seconds, shared_path=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl_seconds
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # key -> (response, doc_ids, size, expires_at)
+        self.documents = {} # doc_id -> keys of the entries listing it
+        self.size_bytes = 0
+        self.generation = None # Unknown until the first check, the cache stays unused
+        self.stats = Counter()
+        self.conn = None
+        if shared_path:
+            os.makedirs(os.path.dirname(shared_path) or ".", exist_ok=True)
+            self.conn = sqlite3.connect(shared_path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS query_cache ("
+                "key TEXT PRIMARY KEY, generation TEXT NOT NULL, response TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS query_cache_documents (doc_id TEXT NOT NULL, key TEXT NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS query_cache_documents_doc_id ON query_cache_documents (doc_id)")
+            self.conn.commit()
+
+    def key(self, request):
+        """Hashes the request with its text normalized, so every filter parameter is part of the key."""
+        fields = request.model_dump()
+        fields["text"] = " ".join(unicodedata.normalize("NFC", fields["text"]).split())
+        return hashlib.sha256(json.dumps(fields, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Returns the cached response, or None."""
+        with self.lock:
+            if self.generation is None:
+                return None
+            entry = self.entries.get(key)
+            if entry is not None and entry[3] <= time.time():
+                self._remove(key)
+                self.stats["expired"] += 1
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[0]
+            if self.conn is not None:
+                row = self.conn.execute(
+                    "SELECT response, expires_at FROM query_cache WHERE key = ? AND generation = ?",
+                    (key, self.generation)
+                ).fetchone()
+                if row is not None and row[1] > time.time():
+                    response = json.loads(row[0])
+                    self._add(key, response, response_doc_ids(response), len(row[0]), row[1])
+                    self.stats["shared_hits"] += 1
+                    return response
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key, response, generation):
+        """Stores a response computed while `generation` was current."""
+        doc_ids = response_doc_ids(response)
+        serialized = json.dumps(response, ensure_ascii=False)
+        expires_at = time.time() + self.ttl
+        with self.lock:
+            if generation is None or generation != self.generation or len(serialized) > self.max_bytes:
+                return
+            self._add(key, response, doc_ids, len(serialized), expires_at)
+            if self.conn is not None:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO query_cache (key, generation, response, expires_at) VALUES (?, ?, ?, ?)",
+                    (key, generation, serialized, expires_at)
+                )
+                self.conn.execute("DELETE FROM query_cache_documents WHERE key = ?", (key,))
+                self.conn.executemany(
+                    "INSERT INTO query_cache_documents (doc_id, key) VALUES (?, ?)", [(doc_id, key) for doc_id in doc_ids]
+                )
+                self.conn.commit()
+
+    def _add(self, key, response, doc_ids, size, expires_at):
+        self._remove(key)
+        self.entries[key] = (response, doc_ids, size, expires_at)
+        self.size_bytes += size
+        for doc_id in doc_ids:
+            self.documents.setdefault(doc_id, set()).add(key)
+        while self.size_bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.stats["evictions"] += 1
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.size_bytes -= entry[2]
+        for doc_id in entry[1]:
+            keys = self.documents.get(doc_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.documents[doc_id]
+
+    def invalidate_document(self, doc_id):
+        """Drops every entry whose response lists a chunk of `doc_id`."""
+        with self.lock:
+            keys = set(self.documents.get(doc_id, ()))
+            for key in keys:
+                self._remove(key)
+            if self.conn is not None:
+                keys.update(row[0] for row in self.conn.execute(
+                    "SELECT key FROM query_cache_documents WHERE doc_id = ?", (doc_id,)
+                ))
+                self.conn.executemany("DELETE FROM query_cache WHERE key = ?", [(key,) for key in keys])
+                self.conn.executemany("DELETE FROM query_cache_documents WHERE key = ?", [(key,) for key in keys])
+                self.conn.commit()
+            self.stats["invalidated"] += len(keys)
+
+    def set_generation(self, generation):
+        """Switches to `generation`, or disables the cache if None, clearing it on any change."""
+        with self.lock:
+            if generation == self.generation:
+                return
+            self.stats["generation_changes"] += 1
+            self.stats["invalidated"] += len(self.entries)
+            self.entries.clear()
+            self.documents.clear()
+            self.size_bytes = 0
+            self.generation = generation
+        self.purge_shared()
+
+    def purge_shared(self):
+        """Deletes expired entries and entries of other generations from the shared store."""
+        with self.lock:
+            if self.conn is None or self.generation is None:
+                return
+            stale = "SELECT key FROM query_cache WHERE generation != ? OR expires_at <= ?"
+            params = (self.generation, time.time())
+            self.conn.execute(f"DELETE FROM query_cache_documents WHERE key IN ({stale})", params)
+            self.conn.execute(f"DELETE FROM query_cache WHERE key IN ({stale})", params)
+            self.conn.commit()
+
+    def summary(self):
+        with self.lock:
+            stats = dict(self.stats)
+            lookups = stats.get("hits", 0) + stats.get("shared_hits", 0) + stats.get("misses", 0)
+            stats["hit_rate"] = round((lookups - stats.get("misses", 0)) / lookups, 4) if lookups else 0
+            stats["entries"] = len(self.entries)
+            stats["size_mb"] = round(self.size_bytes / 2**20, 2)
+            stats["generation"] = self.generation
+            return stats
 
-def get_embeddings(texts):
-    response = requests.post(EMBEDDING_SERVICE_URL, json={"texts": texts})
-    response.raise_for_status()
-    return response.json()["embeddings"]
+def response_doc_ids(response):
+    """Returns the ids of all documents whose chunks appear in a query response."""
+    doc_ids = set()
+    for payload in response["results"]:
+        doc_ids.update(payload.get("doc_ids") or [payload["metadata"]["doc_id"]])
+    return doc_ids
 
-def rerank(query, docs):
-    response = requests.post(RERANKER_SERVICE_URL, json={"query": query, "docs": docs})
-    response.raise_for_status()
-    return response.json()["scores"]
+query_cache = QueryCache(QUERY_CACHE_MAX_MB * 2**20, QUERY_CACHE_TTL_SECONDS, QUERY_CACHE_PATH) if QUERY_CACHE_MAX_MB > 0 else None
+
+async def cache_call(fn, *args):
+    """Runs a query cache method, in a worker thread if it touches the shared SQLite store."""
+    if query_cache.conn is None:
+        return fn(*args)
+    return await asyncio.to_thread(fn, *args)
+
+async def watch_generation():
+    """Polls the collection generation and clears the query cache when the collection changed."""
+    while True:
+        # Any error ending this loop would leave the cache blind to deletes and ingestion runs
+        try:
+            await refresh_generation()
+            await cache_call(query_cache.purge_shared)
+        except Exception as e:
+            print(f"Error maintaining the query cache: {e}")
+        await asyncio.sleep(GENERATION_CHECK_SECONDS)
+
+async def refresh_generation():
+    try:
+        generation = await asyncio.to_thread(read_generation, minio_client, MINIO_BUCKET)
+    except Exception as e:
+        # Without a known generation, cached responses could outlive deleted chunks
+        print(f"Error reading the collection generation, bypassing the query cache: {e}")
+        generation = None
+    await cache_call(query_cache.set_generation, generation)
+
+async def get_embeddings(texts):
+    return (await embedding_client.post_json({"texts": texts}))["embeddings"]
+
+async def rerank(query, docs, top_k, client=reranker_client):
+    """Returns the indices of the `top_k` best docs, best first."""
+    payload = {"query": query, "docs": docs, "top_k": top_k}
+    if RERANK_MAX_DOC_TOKENS:
+        payload["max_doc_tokens"] = RERANK_MAX_DOC_TOKENS
+    return [result["index"] for result in (await client.post_json(payload))["results"]]
+
+@app.on_event("startup")
+async def startup():
+    global query_slots
+    query_slots = asyncio.Semaphore(MAX_CONCURRENT_QUERIES)
+    if query_cache is not None:
+        asyncio.create_task(watch_generation())
+
+@app.on_event("shutdown")
+async def shutdown():
+    for client in [embedding_client, reranker_client, first_stage_client]:
+        if client is not None:
+            await client.aclose()
+    await qdrant_client.close()
+    qdrant_sync_client.close()
 
 @app.post("/query")
-def query(request: QueryRequest):
+async def query(request: QueryRequest):
     try:
-        query_embedding = get_embeddings([request.text])[0]
+        if query_cache is None:
+            return await asyncio.wait_for(run_query(request.text), QUERY_TIMEOUT_SECONDS)
+        key = query_cache.key(request)
+        try:
+            response = await cache_call(query_cache.get, key)
+        except Exception as e:
+            print(f"Error reading the query cache, treating it as a miss: {e}")
+            response = None
+        if response is None:
+            generation = query_cache.generation
+            response = await asyncio.wait_for(run_query(request.text), QUERY_TIMEOUT_SECONDS)
+            try:
+                await cache_call(query_cache.put, key, response, generation)
+            except Exception as e:
+                print(f"Error writing the query cache: {e}")
+        return response
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail=f"Query timed out after {QUERY_TIMEOUT_SECONDS} seconds")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def run_query(text):
+    async with query_slots:
+        query_embedding = (await get_embeddings([text]))[0]
 
-        search_results = qdrant_client.search(
+        search_results = await qdrant_client.search(
             collection_name=COLLECTION_NAME,
             query_vector=query_embedding,
-            limit=10 # Number of results to retrieve
+            limit=SEARCH_LIMIT
         )
 
+        # Narrow the candidates down with the cheap first-stage reranker
+        if first_stage_client is not None and len(search_results) > FIRST_STAGE_TOP_N:
+            candidates = [result.payload["text"] for result in search_results]
+            try:
+                shortlist = await rerank(text, candidates, FIRST_STAGE_TOP_N, client=first_stage_client)
+                search_results = [search_results[i] for i in shortlist]
+            except Exception as e:
+                # Slower, but the main reranker can score all candidates itself
+                print(f"First-stage reranker failed, reranking all {len(candidates)} candidates: {e}")
+
         # Rerank the results
         docs_to_rerank = [result.payload["text"] for result in search_results]
-        scores = rerank(request.text, docs_to_rerank)
-
-        reranked_results = sorted(zip(scores, search_results), key=lambda x: x[0], reverse=True)
-
-        return {"results": [result.payload for score, result in reranked_results]}
+        ranking = await rerank(text, docs_to_rerank, RERANK_TOP_K) if docs_to_rerank else []
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        return {"results": [search_results[i].payload for i in ranking]}
 
 @app.delete("/document/{doc_id}")
-def delete_document(doc_id: str):
+async def delete_document(doc_id: str):
     """Deletes a document from MinIO and Qdrant based on its doc_id."""
     try:
         # 1. Delete from Qdrant
+        # Chunks other documents share with this one must survive the delete
+        operations = await asyncio.to_thread(release_operations, qdrant_sync_client, COLLECTION_NAME, doc_id)
         # Qdrant allows deleting points by filter. We filter by the 'doc_id' in the payload metadata.
-        qdrant_client.delete(
-            collection_name=COLLECTION_NAME,
-            points_selector=models.FilterSelector(
+        operations.append(models.DeleteOperation(
+            delete=models.FilterSelector(
                 filter=models.Filter(
                     must=[
                         models.FieldCondition(
@@ -76,12 +359,33 @@ def delete_document(doc_id: str):
                     ]
                 )
             )
+        ))
+        await qdrant_client.batch_update_points(
+            collection_name=COLLECTION_NAME,
+            update_operations=operations,
+            wait=True
         )
         print(f"Successfully deleted document {doc_id} from Qdrant.")
+        # Drop cached responses pointing at the deleted chunks here, and let
+        # the other replicas clear their caches on their next generation check
+        if query_cache is not None:
+            try:
+                await cache_call(query_cache.invalidate_document, doc_id)
+            except Exception as e:
+                # The generation bump below still invalidates the entries
+                print(f"Error invalidating cached responses of document {doc_id}: {e}")
+        await asyncio.to_thread(bump_generation, minio_client, MINIO_BUCKET, f"delete {doc_id}")
+        if query_cache is not None:
+            # Responses of queries still running against the old generation are not stored
+            try:
+                await refresh_generation()
+            except Exception as e:
+                print(f"Error refreshing the query cache generation: {e}")
 
         # 2. Delete from MinIO
         # The MinIO object name is the doc_id with a .json extension
-        minio_client.remove_object(MINIO_BUCKET, f"{doc_id}.json")
+        # The MinIO client is synchronous, so it runs in a worker thread
+        await asyncio.to_thread(minio_client.remove_object, MINIO_BUCKET, f"{doc_id}.json")
         print(f"Successfully deleted document {doc_id}.json from MinIO bucket {MINIO_BUCKET}.")
 
         return {"status": "success", "message": f"Document {doc_id} deleted successfully."}
@@ -90,6 +394,15 @@ def delete_document(doc_id: str):
         print(f"Error deleting document {doc_id}: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to delete document {doc_id}: {str(e)}")
 
+@app.get("/stats")
+def stats():
+    """Returns per-endpoint latency and error statistics of the upstream service calls and query cache statistics."""
+    clients = [embedding_client, reranker_client] + ([first_stage_client] if first_stage_client is not None else [])
+    return {
+        "upstreams": [client.stats() for client in clients],
+        "query_cache": query_cache.summary() if query_cache is not None else None,
+    }
+
 @app.get("/health")
 def health():
     return {"status": "ok"}